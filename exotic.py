@@ -67,6 +67,7 @@ import json
 import logging
 import platform
 import argparse
+import multiprocessing
 import glob as g
 from io import StringIO
 
@@ -93,6 +94,7 @@ plt.style.use(astropy_mpl_style)
 
 # MCMC imports
 import pymc3 as pm
+import theano
 import theano.compile.ops as tco
 import theano.tensor as tt
 
@@ -109,8 +111,8 @@ from astropy.wcs import WCS
 import astroalign as aa
 
 # photometry
-from photutils import CircularAperture
-from photutils import aperture_photometry
+from collections import OrderedDict
+from photutils.geometry import circular_overlap_grid
 
 # cross corrolation imports
 from skimage.registration import phase_cross_correlation
@@ -119,6 +121,7 @@ from skimage.registration import phase_cross_correlation
 # TODO fix conflicts
 from gaelLCFuncs import *
 from occultquad import *
+from theanoLCFuncs import *
 
 # long process here
 # time.sleep(10)
@@ -127,6 +130,71 @@ done = True
 # ################### START PROPERTIES ########################################
 # CONFIGURATIONS
 requests_timeout = 16, 512  # connection timeout, response timeout in secs.
+# interpolate a table of the transit model built once per set of limb darkening
+# coefficients instead of calling occultquad at every model evaluation; the table
+# is accurate to ~1e-5 in relative flux, its measured error is printed when built
+occultquad_grid = False
+occultquad_cachedir = os.path.join(os.path.expanduser('~'), '.exotic')  # None to rebuild the table every run
+# 'MCMC' samples the posterior of the final fit, 'Laplace' skips the MCMC and takes the uncertainties
+# from the covariance of the least squares fit, for quick looks; the outputs name the method used
+uncertainty_method = 'MCMC'
+# sampler for the final MCMC fit: 'NUTS' uses the differentiable light curve model in
+# theanoLCFuncs, 'Metropolis' the occultquad model wrapped as a black box op, 'ensemble' the
+# affine invariant ensemble sampler below instead of pymc3
+mcmc_sampler = 'Metropolis'
+nuts_chain_length = 5000  # draws per chain with NUTS, Metropolis runs 100000
+# sample in blocks of 1/mcmc_blocks of the chain length above and stop as soon as the split R-hat of
+# Tmid, RpRs, Am1 and Am2 is below mcmc_rhat_max and their effective sample sizes above mcmc_ess_min
+mcmc_adaptive = False
+mcmc_blocks = 10
+mcmc_block_tune = 200  # tuning steps per chain before every block after the first
+mcmc_rhat_max = 1.01
+mcmc_ess_min = 1000
+# start the chains around the weighted least squares optimum, with Metropolis proposals (NUTS mass
+# matrix) from its covariance, instead of from the priors
+mcmc_ls_start = False
+# keep the pymc3 chains on disk (float32, under temp/ of the save directory) instead of in memory,
+# every mcmc_thin-th draw; summaries are computed by streaming over them and loadTraceStore
+# reopens them for re-analysis
+mcmc_trace_store = False
+mcmc_thin = 1
+# the chi squared burn in is estimated from every chi2_burn_stride-th draw of each chain
+chi2_burn_stride = 1
+# ensemble sampler (stretch move of Goodman & Weare 2010) in numpy; each half of the walkers is
+# evaluated in one lcmodel_batch call, split over ensemble_cores processes (None for all cores)
+ensemble_walkers = 64
+ensemble_steps = 3000
+ensemble_stretch = 2.0
+ensemble_cores = None
+# solve for the linear airmass coefficient Am1 in closed form instead of fitting and sampling it;
+# the MCMC explores Tmid, RpRs and Am2 only and Am1 is drawn afterwards from its exact conditional
+marginalize_am1 = False
+# least squares fits of the light curve with the theano Jacobian of lcmodel_jac instead of 2-point finite
+# differences; that Jacobian is of the exact occultquad model, with occultquad_grid it approximates the
+# Jacobian of the interpolated table
+analytic_jacobian = False
+# processes image_alignment registers the frames with (None for all cores, 1 to align in this process)
+alignment_cores = None
+# 'affine' registers every frame with astroalign; 'translation' shifts each frame by the peak of its
+# cross correlation with the first frame (whose spectrum is computed once) and falls back to astroalign
+# for frames whose peak is less than alignment_peak_quality standard deviations above the correlation mean
+alignment_mode = 'affine'
+alignment_peak_quality = 10.
+# half width in pixels of the windows around the target and comparison stars that the shift between
+# consecutive frames is measured in (the median of their shifts); None cross correlates the whole frames.
+# It has to be larger than the drift between two frames.
+registration_window = None
+# 'fit' centroids every star with the rotated gaussian psf fit; 'moments' uses adaptive gaussian weighted
+# moments and fits only the stars whose moments fail the checks of moment_centroid
+centroid_method = 'fit'
+# follow every star with a constant velocity Kalman filter (StarTracker) in the complete reduction, which
+# seeds its centroid fit and sizes the fit box (at most distFC) from its psf width and position uncertainty
+star_tracking = False
+# exact aperture weights are kept for aperture_cache_size combinations of radius and sub-pixel star position (the
+# least recently used are dropped first), with the position rounded to 1/aperture_subpixel_grid pixel (None for
+# the exact position, which rarely repeats)
+aperture_subpixel_grid = 20
+aperture_cache_size = 4096
 
 # SHARED CONSTANTS
 pi = 3.14159
@@ -747,18 +815,41 @@ def check_targetpixelwcs(pixx, pixy, expra, expdec, ralist, declist):
 
 # Aligns imaging data from .fits file to easily track the host and comparison star's positions
 def image_alignment(sortedallImageData):
-    boollist = []
-    notAligned = 0
-
-    # Align images from .FITS files and catch exceptions if images can't be aligned. Keep two lists: newlist for
-    # images aligned and boollist for discarded images to delete .FITS data from airmass and times.
-    for i, image_file in enumerate(sortedallImageData):
+    # The control points (brightest sources) of the reference frame are found once, then the frames are
+    # registered to them over alignment_cores processes, a few frames at a time, and written back into the
+    # stack in place (integer frames are converted to float once so the resampled values are kept)
+    sortedallImageData = np.asarray(sortedallImageData)
+    if not np.issubdtype(sortedallImageData.dtype, np.floating):
+        sortedallImageData = sortedallImageData.astype(float)
+
+    # Align images from .FITS files and catch exceptions if images can't be aligned. Keep boollist for
+    # discarded images to delete .FITS data from airmass and times.
+    if alignment_mode == 'translation':
+        boollist = translateFrames(sortedallImageData, alignment_peak_quality)
+    else:
+        boollist = [False] * len(sortedallImageData)
+    pending = [i for i, aligned in enumerate(boollist) if not aligned]
+
+    if pending:
+        referencePoints = alignmentControlPoints(sortedallImageData[0])
+        processes = min(alignment_cores or os.cpu_count() or 1, len(pending))
+        pool = multiprocessing.Pool(processes, alignInit, (referencePoints,)) if processes > 1 else None
+        if pool is None:
+            alignInit(referencePoints)
         try:
-            sortedallImageData[i], footprint = aa.register(image_file, sortedallImageData[0])
-            boollist.append(True)
-        except:
-            notAligned += 1
-            boollist.append(False)
+            # only 2 * processes frames are in flight at once, so the stack is never copied whole
+            for batch in range(0, len(pending), 2 * processes):
+                indices = pending[batch:batch + 2 * processes]
+                frames = [sortedallImageData[i] for i in indices]
+                for i, aligned in zip(indices, pool.map(alignFrame, frames) if pool else map(alignFrame, frames)):
+                    if aligned is not None:
+                        sortedallImageData[i] = aligned
+                        boollist[i] = True
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+    notAligned = boollist.count(False)
 
     unalignedBoolList = np.array(boollist)
 
@@ -772,6 +863,157 @@ def image_alignment(sortedallImageData):
     return sortedallImageData, unalignedBoolList, boollist
 
 
+# (N, 2) control points of the reference frame for aa.find_transform, through the public astroalign API
+# (2.0.2 in requirements.txt): matching the frame with itself returns the inlier control points of that
+# transform, in no particular order, which find_transform only uses as a set of stars to match against;
+# if that fails the frame itself is the target and its sources are detected for every frame
+def alignmentControlPoints(reference):
+    try:
+        transform, (source, target) = aa.find_transform(reference, reference)
+        return np.asarray(target, dtype=float)
+    except Exception:
+        return reference
+
+
+# reference control points of image_alignment, in every alignment process
+def alignInit(referencePoints):
+    global alignment
+    alignment = {'reference': referencePoints}
+
+
+# frame registered to the reference control points, or None if it can not be aligned
+def alignFrame(frame):
+    try:
+        transform, matches = aa.find_transform(frame, alignment['reference'])
+        aligned, footprint = aa.apply_transform(transform, frame, frame)
+        return aligned
+    except Exception:
+        return None
+
+
+# aligns each frame to the first one, in place, by the whole pixel translation at the peak of their cross
+# correlation; the spectrum of the first frame is computed once and every frame costs one forward and one
+# inverse real FFT. Frames are filled with their median where no pixels shift in, as astroalign does.
+# returns for every frame whether its peak was at least minQuality standard deviations above the mean of
+# the correlation; frames below that are left untouched for the affine registration
+def translateFrames(frames, minQuality):
+    shape = frames[0].shape
+    referenceSpectrum = np.conj(np.fft.rfft2(frames[0] - np.median(frames[0])))
+    aligned = []
+    for frame in frames:
+        background = np.median(frame)
+        correlation = np.fft.irfft2(np.fft.rfft2(frame - background) * referenceSpectrum, s=shape)
+        peak = np.unravel_index(np.argmax(correlation), shape)
+        quality = (correlation[peak] - correlation.mean()) / correlation.std()
+        if not quality >= minQuality:
+            aligned.append(False)
+            continue
+
+        # the peak sits at the (wrapped) offset of the frame from the first one
+        dy, dx = [(p + n // 2) % n - n // 2 for p, n in zip(peak, shape)]
+        shifted = np.full(shape, background)
+        shifted[max(0, -dy):shape[0] - max(0, dy), max(0, -dx):shape[1] - max(0, dx)] = \
+            frame[max(0, dy):shape[0] - max(0, -dy), max(0, dx):shape[1] - max(0, -dx)]
+        frame[:] = shifted
+        aligned.append(True)
+    return aligned
+
+
+# registers every frame to the previous one and fits the centroids of the target and comparison stars in it
+# with one fit_centroids call per frame, once for every comparison star and aperture; stops at the first frame
+# where the target comes within distFC of the detector edge, which is then the last one with a shift
+# stars are the (x, y, sigx, sigy) guesses in the first frame, target first
+# returns the (y, x) shift of each frame and for every star its fit_centroid result in each frame before the
+# one the target drifted in (None in the frames where the star itself is within distFC of the edge)
+# with star_tracking the fits are seeded and their boxes sized by a StarTracker, which also warns ahead of time
+# about stars drifting towards the edge
+def registerFrames(sortedallImageData, stars, distFC, warnFrames=10):
+    shifts, fits = [], [[] for star in stars]
+    prev = np.array(stars, dtype=float)
+    boxes = np.full(len(stars), distFC)
+    tracker = StarTracker(stars) if star_tracking else None
+    warned = set()
+    prevImageData = sortedallImageData[0]  # no shift should be registered
+    for fileNumber, imageData in enumerate(sortedallImageData):
+        # corrects for any image shifts that result from a tracking slip
+        shift = registerShift(prevImageData, imageData, prev[:, :2])
+        shifts.append(shift)
+        prevImageData = imageData
+        if tracker:
+            prev[:, :2] = tracker.predict(shift)
+            prev[:, 2:] = tracker.widths
+            boxes = tracker.boxes(distFC)
+        else:
+            prev[:, :2] -= shift[::-1]
+
+        # set the search areas of the stars that are not too close to the edge of the detector
+        fitted, priors = [], []
+        for n, (x, y, sigX, sigY) in enumerate(prev):
+            xmin = int(x) - distFC  # left
+            xmax = int(x) + distFC  # right
+            ymin = int(y) - distFC  # top
+            ymax = int(y) + distFC  # bottom
+            if xmin <= 0 or ymin <= 0 or xmax >= len(imageData[0]) or ymax >= len(imageData):
+                continue
+            searchA = imageData[ymin:ymax, xmin:xmax]
+
+            # get minimum background value bigger than 0
+            imFlat = np.sort(np.array(searchA).ravel())
+            positive = imFlat[imFlat > 0]
+            guessBkg = positive[0] if len(positive) else 0
+
+            # Guess at Gaussian Parameters and feed them in to help gaussian fitter
+            guessAmp = searchA.max() - guessBkg
+            if guessAmp < 0:
+                print('Error: the Darks have a higher pixel counts than the image itself')
+            fitted.append(n)
+            priors.append([guessAmp, sigX, sigY, 0, guessBkg])
+        if not fitted or fitted[0] != 0:
+            break
+
+        frameFits = dict(zip(fitted, fit_centroids([imageData] * len(fitted), prev[fitted, :2], priors,
+                                                   box=boxes[fitted])))
+        for n in range(len(stars)):
+            fits[n].append(frameFits.get(n))
+            if n in frameFits:
+                x, y, amplitude, sigX, sigY, rot, off = frameFits[n]
+                if amplitude >= 0 and sigX >= 0 and sigY >= 0:
+                    prev[n] = x, y, sigX, sigY
+                    if tracker:
+                        tracker.update(n, x, y, sigX, sigY)
+
+            if tracker and n not in warned:
+                edge = tracker.framesToEdge(n, np.shape(imageData), distFC)
+                if edge < warnFrames:
+                    print('WARNING: In image ' + str(fileNumber) + ', ' +
+                          ('your target star' if n == 0 else 'comparison star #' + str(n)) +
+                          ' is drifting towards the edge of the detector and will be too close to it in about ' +
+                          str(int(np.ceil(edge))) + ' images.')
+                    warned.add(n)
+    return shifts, fits
+
+
+# (y, x) shift that registers imageData with prevImageData, as phase_cross_correlation measures it; with a
+# registration_window it is the median of the shifts in the windows around the stars ((x, y) positions in
+# prevImageData) that lie fully on the detector, so its cost does not depend on the frame size
+def registerShift(prevImageData, imageData, stars):
+    if registration_window:
+        windowShifts = []
+        for x, y in stars:
+            xmin, ymin = int(x) - registration_window, int(y) - registration_window
+            xmax, ymax = int(x) + registration_window, int(y) + registration_window
+            if xmin < 0 or ymin < 0 or ymax > len(imageData) or xmax > len(imageData[0]):
+                continue
+            shift, error, diffphase = phase_cross_correlation(prevImageData[ymin:ymax, xmin:xmax],
+                                                              imageData[ymin:ymax, xmin:xmax])
+            windowShifts.append(shift)
+        if windowShifts:
+            return np.median(windowShifts, axis=0)
+
+    shift, error, diffphase = phase_cross_correlation(prevImageData, imageData)
+    return shift
+
+
 # defines the star point spread function as a 2D Gaussian
 def star_psf(x, y, x0, y0, a, sigx, sigy, b):
     gaus = a * np.exp(-(x - x0) ** 2 / (2 * sigx ** 2)) * np.exp(-(y - y0) ** 2 / (2 * sigy ** 2)) + b
@@ -796,6 +1038,24 @@ def gaussian_psf(x,y,x0,y0,a,sigx,sigy,rot, b):
     return a*gausx*gausy + b
 
 
+# derivatives of gaussian_psf with respect to [x0, y0, a, sigx, sigy, rot, b], stacked along a new last axis
+def gaussian_psf_jacobian(x,y,x0,y0,a,sigx,sigy,rot, b):
+    rx = (x-x0)*np.cos(rot) - (y-y0)*np.sin(rot)
+    ry = (x-x0)*np.sin(rot) + (y-y0)*np.cos(rot)
+    gaus = np.exp(-(rx)**2 / (2*sigx**2) - (ry)**2 / (2*sigy**2))
+    drx = -a*gaus*rx/sigx**2
+    dry = -a*gaus*ry/sigy**2
+    return np.stack([
+        -drx*np.cos(rot) - dry*np.sin(rot),
+        drx*np.sin(rot) - dry*np.cos(rot),
+        gaus,
+        -drx*rx/sigx,
+        -dry*ry/sigy,
+        -drx*ry + dry*rx,
+        np.ones_like(gaus)
+    ], axis=-1)
+
+
 def fit_psf(data,pos,init,lo,up,psf_function=gaussian_psf,lossfn='linear',box=15):
     xv,yv = mesh_box(pos, box)
     def fcn2min(pars):
@@ -805,6 +1065,51 @@ def fit_psf(data,pos,init,lo,up,psf_function=gaussian_psf,lossfn='linear',box=15
     return res.x
 
 
+# fits gaussian_psf to N stamps at once with a Levenberg-Marquardt that uses its analytic derivatives;
+# every stamp has its own damping and stops on its own, steps are clipped to the bounds [lo, up]
+# stamps, xv and yv are (N, pixels), init, lo and up are (N, 7) as [xc, yc, amp, sigx, sigy, rotation, bg]
+def fit_psf_batch(stamps,xv,yv,init,lo,up,maxiter=100,ftol=1e-8):
+    pars = np.clip(np.array(init, dtype=float), lo, up)
+    res = stamps - gaussian_psf(xv,yv,*pars.T[...,None])
+    cost = np.sum(res**2, axis=1)
+    damping = np.full(len(pars), 1e-3)
+    active = np.arange(len(pars))
+    for i in range(maxiter):
+        if not len(active):
+            break
+        jac = gaussian_psf_jacobian(xv[active],yv[active],*pars[active].T[...,None])
+        jtj = np.einsum('nmi,nmj->nij', jac, jac)
+        grad = np.einsum('nmi,nm->ni', jac, res[active])
+        # parameters on a bound that the gradient pushes out of are held there for this step
+        held = ((pars[active] <= lo[active]) & (grad < 0)) | ((pars[active] >= up[active]) & (grad > 0))
+        jtj[np.broadcast_to(held[:,None,:], jtj.shape) | np.broadcast_to(held[:,:,None], jtj.shape)] = 0
+        grad[held] = 0
+        scale = np.einsum('nii->ni', jtj)
+        scale = np.where(held, 1, scale + 1e-12*scale.max(axis=1, keepdims=True) + 1e-300)
+        jtj[:, np.arange(7), np.arange(7)] += damping[active, None] * scale + held
+        step = np.linalg.solve(jtj, grad[...,None])[...,0]
+
+        # a rotation by a quarter turn is the same psf with sigx and sigy swapped, which keeps the rotation
+        # within its bounds of +-pi/4 instead of stopping on them
+        trial = pars[active] + step
+        turns = np.round(trial[:,5] / (np.pi/2))
+        trial[:,5] -= turns * np.pi/2
+        trial[turns % 2 == 1, 3:5] = trial[turns % 2 == 1, 4:2:-1]
+        trial = np.clip(trial, lo[active], up[active])
+        trialRes = stamps[active] - gaussian_psf(xv[active],yv[active],*trial.T[...,None])
+        trialCost = np.sum(trialRes**2, axis=1)
+
+        better = trialCost < cost[active]
+        accepted = active[better]
+        converged = cost[accepted] - trialCost[better] <= ftol * cost[accepted]
+        pars[accepted], res[accepted], cost[accepted] = trial[better], trialRes[better], trialCost[better]
+        damping[active] = np.where(better, damping[active] / 10, damping[active] * 10)
+        done = np.zeros(len(active), dtype=bool)
+        done[better] = converged
+        active = active[~done & (damping[active] < 1e10)]
+    return pars
+
+
 def mesh_box(pos,box):
     pos = [int(np.round(pos[0])), int(np.round(pos[1]))]
     x = np.arange(pos[0]-box, pos[0]+box+1)
@@ -820,28 +1125,175 @@ def fit_centroid(data, pos, init=None, box=10):
     xv, yv = mesh_box(pos, box)
     wx, wy = pos # could take flux weighted centroid if not crowded
 
+    if centroid_method == 'moments':
+        pars = moment_centroid(data, pos, box)
+        if pars is not None:
+            return pars
+
     if init:
         pass
     else:
         init = [np.nanmax(data[yv,xv])-np.nanmin(data[yv,xv]), 1, 1, 0, np.nanmin(data[yv,xv])]
 
-    try:
-        # fit gaussian PSF
-        pars = fit_psf(
-            data,
-            [wx, wy],  # position estimate
-            init,    # initial guess: [amp, sigx, sigy, rotation, bg]
-            [wx-5, wy-5, 0, 0, 0, -np.pi/4, np.nanmin(data)-1 ], # lower bound: [xc, yc, amp, sigx, sigy, rotation,  bg]
-            [wx+5, wy+5, 1e7, 20, 20, np.pi/4, np.nanmax(data[yv,xv])+1 ], # upper bound
-            psf_function=gaussian_psf,
-            box=box  # only fit a subregion +/- 5 px from centroid
-        )
-    except:
-        import pdb; pdb.set_trace()
+    # fit gaussian PSF
+    pars = fit_psf(
+        data,
+        [wx, wy],  # position estimate
+        init,    # initial guess: [amp, sigx, sigy, rotation, bg]
+        [wx-5, wy-5, 0, 0, 0, -np.pi/4, np.nanmin(data)-1 ], # lower bound: [xc, yc, amp, sigx, sigy, rotation,  bg]
+        [wx+5, wy+5, 1e7, 20, 20, np.pi/4, np.nanmax(data[yv,xv])+1 ], # upper bound
+        psf_function=gaussian_psf,
+        box=box  # only fit a subregion +/- 5 px from centroid
+    )
+
+    return pars
+
 
+# centroid from adaptive moments: the second moments of the star, weighted by a gaussian with twice their
+# covariance, are iterated until that gaussian is the star's (the fixed point for a gaussian psf); amplitude and
+# background then follow from a linear fit of that gaussian to the (2*box+1)**2 pixel stamp around pos
+# returns [xc, yc, amp, sigx, sigy, rotation, bg] as fit_centroid does, or None if the moments do not
+# converge, leave the stamp, give a sigma outside [0.3, box/2] pixels, a brightest pixel more than twice the
+# smaller sigma from pos or the centroid (a blend or a cosmic ray), or a non positive amplitude
+def moment_centroid(data, pos, box=10, maxiter=30, tol=1e-3):
+    xv, yv = mesh_box(pos, box)
+    stamp = data[yv,xv].astype(float)
+    border = np.concatenate([stamp[0], stamp[-1], stamp[1:-1,0], stamp[1:-1,-1]])
+    signal = stamp - np.nanmedian(border)
+    if not np.all(np.isfinite(signal)):
+        return None
+
+    xc, yc = pos
+    cov = np.eye(2) * 4
+    for i in range(maxiter):
+        dx, dy = xv - xc, yv - yc
+        inv = np.linalg.inv(cov)
+        weight = signal * np.exp(-0.5 * (inv[0,0]*dx**2 + 2*inv[0,1]*dx*dy + inv[1,1]*dy**2))
+        norm = weight.sum()
+        if not norm > 0:
+            return None
+        mx, my = (weight*dx).sum() / norm, (weight*dy).sum() / norm
+        moments = np.array([[(weight*(dx-mx)**2).sum(), (weight*(dx-mx)*(dy-my)).sum()],
+                            [(weight*(dx-mx)*(dy-my)).sum(), (weight*(dy-my)**2).sum()]]) / norm
+        xc, yc = xc + mx, yc + my
+        newCov = 2 * moments
+        if not np.linalg.det(newCov) > 0 or abs(xc - pos[0]) > box / 2 or abs(yc - pos[1]) > box / 2:
+            return None
+        converged = np.hypot(mx, my) < tol and np.all(np.abs(newCov - cov) < tol * np.trace(cov))
+        cov = newCov
+        if converged:
+            break
+    else:
+        return None
+
+    # rotation and sigmas of gaussian_psf whose covariance is cov, with the rotation within +-pi/4
+    rot = 0.5 * np.arctan(-2 * cov[0,1] / (cov[0,0] - cov[1,1])) if cov[0,0] != cov[1,1] else np.pi/4
+    spread = (cov[0,0] - cov[1,1]) * np.cos(2*rot) - 2 * cov[0,1] * np.sin(2*rot)
+    sigx = np.sqrt(max(0, 0.5 * (np.trace(cov) + spread)))
+    sigy = np.sqrt(max(0, 0.5 * (np.trace(cov) - spread)))
+    if not (0.3 <= min(sigx, sigy) and max(sigx, sigy) <= box / 2):
+        return None
+    peak = np.unravel_index(np.argmax(signal), signal.shape)
+    if max(np.hypot(xv[peak] - xc, yv[peak] - yc), np.hypot(xv[peak] - pos[0], yv[peak] - pos[1])) > 2 * min(sigx, sigy):
+        return None
+
+    shape = gaussian_psf(xv, yv, xc, yc, 1, sigx, sigy, rot, 0).ravel()
+    design = np.stack([shape, np.ones_like(shape)], axis=1)
+    (amp, bg), *_ = np.linalg.lstsq(design, stamp.ravel(), rcond=None)
+    if not amp > 0:
+        return None
+    return np.array([xc, yc, amp, sigx, sigy, rot, bg])
+
+
+# fit_centroid for several stars (in the same or different images) with one call to fit_psf_batch per box size
+# (for the stars whose moments fail, with the 'moments' centroid_method); the stars are fitted in (2*box+1)**2
+# pixel stamps, box can be one for every star, with the bounds of fit_centroid (the centroid within min(5, box/2)
+# pixels of pos), returns an (N, 7) array with rows [xc, yc, amp, sigx, sigy, rotation, bg]
+def fit_centroids(images, positions, inits=None, box=10):
+    if not len(positions):
+        return np.empty((0, 7))
+    pars = np.empty((len(positions), 7))
+    boxes = np.broadcast_to(box, len(positions))
+    stamps, xvs, yvs, x0, lo, up, fitted = [], [], [], [], [], [], []
+    for n, (data, pos) in enumerate(zip(images, positions)):
+        if centroid_method == 'moments':
+            moments = moment_centroid(data, pos, boxes[n])
+            if moments is not None:
+                pars[n] = moments
+                continue
+        fitted.append(n)
+        xv, yv = mesh_box(pos, boxes[n])
+        reach = min(5, boxes[n] / 2)
+        stamp = data[yv,xv]
+        wx, wy = pos
+        init = inits[n] if inits is not None else \
+            [np.nanmax(stamp)-np.nanmin(stamp), 1, 1, 0, np.nanmin(stamp)]
+        stamps.append(stamp.ravel())
+        xvs.append(xv.ravel())
+        yvs.append(yv.ravel())
+        x0.append([wx, wy, *init])
+        lo.append([wx-reach, wy-reach, 0, 1e-3, 1e-3, -np.pi/4, np.nanmin(data)-1])
+        up.append([wx+reach, wy+reach, 1e7, 20, 20, np.pi/4, np.nanmax(stamp)+1])
+    for size in np.unique(boxes[fitted]):
+        group = [i for i, n in enumerate(fitted) if boxes[n] == size]
+        pars[np.array(fitted)[group]] = fit_psf_batch(
+            np.array([stamps[i] for i in group], dtype=float), np.array([xvs[i] for i in group]),
+            np.array([yvs[i] for i in group]), np.array(x0)[group], np.array(lo)[group], np.array(up)[group])
     return pars
 
 
+# constant velocity Kalman filter on the (x, y) position of every star, in the pixels of the registered frames,
+# with a random walk filter on its psf widths; the measured frame shift is applied to the prediction as a known
+# motion, the velocity follows the drift left after it (differential refraction, field rotation, a poor shift)
+class StarTracker:
+    def __init__(self, stars, positionNoise=0.1, driftNoise=0.02, widthNoise=0.05):
+        # stars are (x, y, sigx, sigy) first guesses
+        stars = np.array(stars, dtype=float)
+        self.state = np.zeros((len(stars), 4))  # x, y, vx, vy
+        self.state[:, :2] = stars[:, :2]
+        self.cov = np.tile(np.diag([1., 1., driftNoise, driftNoise]), (len(stars), 1, 1))
+        self.widths = stars[:, 2:4].copy()
+        self.widthVar = np.ones((len(stars), 2))
+        self.transition = np.array([[1., 0, 1, 0], [0, 1, 0, 1], [0, 0, 1, 0], [0, 0, 0, 1]])
+        self.process = np.diag([0., 0., driftNoise**2, driftNoise**2])
+        self.positionNoise = positionNoise
+        self.widthNoise = widthNoise
+
+    # moves every star one frame ahead and by the (y, x) frame shift, returns the predicted (x, y) positions
+    def predict(self, shift):
+        self.state = self.state @ self.transition.T
+        self.state[:, :2] -= shift[::-1]
+        self.cov = self.transition @ self.cov @ self.transition.T + self.process
+        self.widthVar += self.widthNoise**2
+        return self.state[:, :2].copy()
+
+    # half width of the fit box of every star: three psf widths plus three standard deviations of its predicted
+    # position, within [minBox, maxBox] pixels
+    def boxes(self, maxBox, minBox=4):
+        spread = np.sqrt(np.maximum(self.cov[:, 0, 0], self.cov[:, 1, 1]))
+        return np.clip(np.ceil(3 * self.widths.max(axis=1) + 3 * spread), minBox, maxBox).astype(int)
+
+    # folds the fitted position and psf widths of star n into its filters
+    def update(self, n, x, y, sigx, sigy):
+        gain = self.cov[n][:, :2] @ np.linalg.inv(self.cov[n][:2, :2] + np.eye(2) * self.positionNoise**2)
+        self.state[n] += gain @ (np.array([x, y]) - self.state[n, :2])
+        self.cov[n] -= gain @ self.cov[n][:2]
+        widthGain = self.widthVar[n] / (self.widthVar[n] + self.widthNoise**2)
+        self.widths[n] += widthGain * (np.array([sigx, sigy]) - self.widths[n])
+        self.widthVar[n] *= 1 - widthGain
+
+    # frames until the box of half width margin around star n reaches the edge of a detector of the given
+    # (rows, columns) shape at its current velocity (inf if it is not moving towards an edge)
+    def framesToEdge(self, n, shape, margin):
+        frames = np.inf
+        for position, velocity, size in zip(self.state[n, :2], self.state[n, 2:], shape[::-1]):
+            if velocity > 1e-6:
+                frames = min(frames, (size - margin - position) / velocity)
+            elif velocity < -1e-6:
+                frames = min(frames, (position - margin) / -velocity)
+        return max(frames, 0)
+
+
 # Method calculates the flux of the star (uses the skybg_phot method to do backgorund sub)
 def getFlux(data, xc, yc, r=5, dr=5):
 
@@ -849,14 +1301,91 @@ def getFlux(data, xc, yc, r=5, dr=5):
         bgflux = skybg_phot(data, xc, yc, r, dr)
     else:
         bgflux = 0
-    positions = [(xc, yc)]
-    data = data-bgflux
-    data[data < 0] = 0
 
-    apertures = CircularAperture(positions, r=r)
-    phot_table = aperture_photometry(data, apertures, method='exact')
+    # only the pixels around the aperture are background subtracted
+    stamp, xmin, ymin = cutout(data, xc, yc, int(np.ceil(r)) + 1)
+    stamp = stamp-bgflux
+    stamp[stamp < 0] = 0
+
+    return apertureFlux(stamp, xmin, ymin, xc, yc, r), bgflux
+
+
+# exact weights (the fraction of each pixel inside the circle) of circular apertures, kept in a least recently
+# used cache keyed by the radius and the offset of the centre from the nearest pixel, rounded to 1/grid pixel
+class ApertureWeights:
+    def __init__(self, grid=20, size=4096):
+        self.grid = grid
+        self.size = size
+        self.weights = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # weights of the aperture of radius r centred on (xc, yc), with the column and row of their first pixel
+    def __call__(self, r, xc, yc):
+        x0, y0 = int(np.round(xc)), int(np.round(yc))
+        dx, dy = xc - x0, yc - y0
+        if self.grid:
+            dx, dy = np.round(dx * self.grid) / self.grid, np.round(dy * self.grid) / self.grid
+        half = int(np.ceil(r)) + 1
+        key = (float(r), float(dx), float(dy))
+        if key in self.weights:
+            self.hits += 1
+            self.weights.move_to_end(key)
+        else:
+            self.misses += 1
+            self.weights[key] = circular_overlap_grid(-half - 0.5 - dx, half + 0.5 - dx, -half - 0.5 - dy,
+                                                      half + 0.5 - dy, 2*half + 1, 2*half + 1, r, 1, 1)
+            if len(self.weights) > self.size:
+                self.weights.popitem(last=False)
+        return self.weights[key], x0 - half, y0 - half
+
+    # fraction of the lookups that were found in the cache
+    def hitRate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+
+apertureWeights = ApertureWeights(aperture_subpixel_grid, aperture_cache_size)
+
+
+# sum of the stamp (whose first pixel is at column xmin, row ymin of the frame) in the aperture of radius r
+# centred on (xc, yc), with the cached exact aperture weights
+def apertureFlux(stamp, xmin, ymin, xc, yc, r):
+    weights, x0, y0 = apertureWeights(r, xc, yc)
+    xa, ya = max(xmin, x0), max(ymin, y0)
+    xb = min(xmin + stamp.shape[1], x0 + weights.shape[1])
+    yb = min(ymin + stamp.shape[0], y0 + weights.shape[0])
+    return float(np.sum(weights[ya-y0:yb-y0, xa-x0:xb-x0] * stamp[ya-ymin:yb-ymin, xa-xmin:xb-xmin]))
+
+
+# the pixels of data within halfWidth pixels (in x and y) of the pixel nearest to (xc, yc), cut at the edges of
+# the frame, as a view of data (nothing is copied); returns it with the column and row of its first pixel
+def cutout(data, xc, yc, halfWidth):
+    xmin = max(int(np.round(xc)) - halfWidth, 0)
+    ymin = max(int(np.round(yc)) - halfWidth, 0)
+    return data[ymin:int(np.round(yc)) + halfWidth + 1, xmin:int(np.round(xc)) + halfWidth + 1], xmin, ymin
+
+
+# getFlux for every aperture radius in radii at once, from the pixels within max(radii) + dr of the star: the
+# background of each annulus (r, r + dr) is found on that stamp as skybg_phot does and the aperture sums use the
+# cached exact aperture weights, returns the arrays of fluxes and backgrounds
+def getFluxes(data, xc, yc, radii, dr=5):
+    radii = np.asarray(radii, dtype=float)
+    stamp, xmin, ymin = cutout(data, xc, yc, int(np.ceil(radii.max() + dr)) + 1)
+    xv, yv = np.meshgrid(np.arange(xmin, xmin + stamp.shape[1]), np.arange(ymin, ymin + stamp.shape[0]))
+    rv = ((xv-xc)**2 + (yv-yc)**2)**0.5
 
-    return float(phot_table['aperture_sum']), bgflux
+    fluxes, bgfluxes = np.empty(len(radii)), np.zeros(len(radii))
+    for i, r in enumerate(radii):
+        if dr > 0:
+            # the annulus pixels of skybg_phot, within its mesh_box around the star
+            box = np.round(r+dr)
+            mask = (rv > r) & (rv < (r+dr)) & \
+                (np.abs(xv - int(np.round(xc))) <= box) & (np.abs(yv - int(np.round(yc))) <= box)
+            annulus = np.minimum(stamp[mask], np.percentile(stamp[mask], 50))  # ignore bright pixels like stars
+            bgflux = min(np.mean(annulus), np.median(annulus))
+            bgfluxes[i] = bgflux
+        fluxes[i] = apertureFlux(np.maximum(stamp - bgfluxes[i], 0), xmin, ymin, xc, yc, r)
+    return fluxes, bgfluxes
 
 
 def skybg_phot(data, xc, yc, r=10, dr=5):
@@ -864,10 +1393,10 @@ def skybg_phot(data, xc, yc, r=10, dr=5):
     xv, yv = mesh_box([xc, yc], np.round(r+dr))
     rv = ((xv-xc)**2 + (yv-yc)**2)**0.5
     mask = (rv > r) & (rv < (r+dr))
-    cutoff = np.percentile(data[yv, xv][mask], 50)
-    dat = np.copy(data)
+    dat = data[yv, xv][mask]  # only the annulus pixels are copied
+    cutoff = np.percentile(dat, 50)
     dat[dat > cutoff] = cutoff # ignore bright pixels like stars
-    return min(np.mean(dat[yv, xv][mask]), np.median(dat[yv, xv][mask]))
+    return min(np.mean(dat), np.median(dat))
 
 
 # Mid-Transit Time Prior Helper Functions
@@ -907,8 +1436,84 @@ def chisquared(observed_values, expected_values, uncertainty):
         return chiToReturn
 
 
+# chi squared burn in of MCMC chains, updated with the draws added since the last update so it can
+# follow a running sampler; memory does not grow with the chain length: the median chi squared is
+# taken from a fixed size reservoir sample, each chain keeps only its record lows (the first draw at
+# or below the median is one of them) and a decimated chi squared trace for the plot
+class Chi2Burn:
+    def __init__(self, myFluxes, myTimes, theAirmasses, uncertainty, stride=1, reservoir=65536, plotPoints=2048,
+                 block=8192):
+        self.fluxes = myFluxes
+        self.times = myTimes
+        self.airmasses = theAirmasses
+        self.uncertainty = uncertainty
+        self.geometry = OrbitGeometry(myTimes, pDict['inc'], pDict['aRs'], pDict['pPer'], pDict['ecc'])
+        self.stride = stride
+        self.block = block  # samples per lcmodel_batch call
+        self.next = 0  # next draw to evaluate
+        self.reservoir = np.empty(reservoir)
+        self.seen = 0
+        self.plotPoints = plotPoints
+        self.plotStride = stride
+        self.records = None
+        self.plot = None
+
+    # chi squared of the draws of every chain from self.next on
+    def update(self, samples):
+        nchains, ndraws = samples['Tmid'].shape
+        if self.records is None:
+            self.records = [[] for chain in range(nchains)]
+            self.plot = [[] for chain in range(nchains)]
+            self.lowest = np.full(nchains, np.inf)
+        span = max(1, self.block // nchains) * self.stride
+        for start in range(self.next, ndraws, span):
+            draws = slice(start, min(start + span, ndraws), self.stride)
+            indices = np.arange(ndraws)[draws]
+            fittedModels = lcmodel_batch(np.ravel(samples['Tmid'][:, draws]), np.ravel(samples['RpRs'][:, draws]),
+                                         np.ravel(samples['Am1'][:, draws]), np.ravel(samples['Am2'][:, draws]),
+                                         self.times, self.airmasses, geometry=self.geometry)
+            fittedModels -= self.fluxes
+            fittedModels /= self.uncertainty
+            chi2 = (np.sum(fittedModels ** 2., axis=1) / (len(self.fluxes) - 4)).reshape(nchains, len(indices))
+
+            # new lows of every chain
+            running = np.fmin(np.fmin.accumulate(chi2, axis=1), self.lowest[:, np.newaxis])  # NaN chi2 are skipped
+            records = chi2 < np.concatenate([self.lowest[:, np.newaxis], running[:, :-1]], axis=1)
+            self.lowest = running[:, -1]
+            for chain in range(nchains):
+                self.records[chain].extend(zip(indices[records[chain]], chi2[chain, records[chain]]))
+
+            # reservoir sampling (algorithm R) of the chi squared values
+            values = chi2[np.isfinite(chi2)]
+            ranks = self.seen + np.arange(len(values))
+            slots = np.where(ranks < len(self.reservoir), ranks, (np.random.rand(len(values)) * (ranks + 1)).astype(int))
+            keep = slots < len(self.reservoir)
+            self.reservoir[slots[keep]] = values[keep]
+            self.seen += len(values)
+
+            # plotted trace, halved whenever it grows past plotPoints per chain
+            plotted = indices % self.plotStride == 0
+            for chain in range(nchains):
+                self.plot[chain].extend(zip(indices[plotted], chi2[chain, plotted]))
+            while len(self.plot[0]) > self.plotPoints:
+                self.plotStride *= 2
+                self.plot = [[point for point in chainplot if point[0] % self.plotStride == 0] for chainplot in self.plot]
+            self.next = indices[-1] + self.stride
+
+    def median(self):
+        return np.median(self.reservoir[:min(self.seen, len(self.reservoir))])
+
+    # largest over the chains of the first draw at or below the median chi squared, 0 if there is none
+    def burn(self):
+        chiMedian = self.median()
+        burns = [next((index for index, chi2 in chainrecords if chi2 <= chiMedian), 0) for chainrecords in self.records]
+        return int(np.max(burns))
+
+
 # make and plot the chi squared traces
-def plotChi2Trace(myTrace, myFluxes, myTimes, theAirmasses, uncertainty, targetname, date):
+# samples: {name: (nchains, ndraws) array} as returned by traceArrays; tracker: a Chi2Burn already
+# updated while sampling, to evaluate only the draws it has not seen
+def plotChi2Trace(samples, myFluxes, myTimes, theAirmasses, uncertainty, targetname, date, tracker=None):
     print("Performing Chi^2 Burn")
     print("Please be patient- this step can take a few minutes.")
     global done
@@ -916,31 +1521,15 @@ def plotChi2Trace(myTrace, myFluxes, myTimes, theAirmasses, uncertainty, targetn
     t = threading.Thread(target=animate, daemon=True)
     t.start()
 
-    midTArr = myTrace.get_values('Tmid', combine=False)
-    radiusArr = myTrace.get_values('RpRs', combine=False)
-    am1Arr = myTrace.get_values('Am1', combine=False)
-    am2Arr = myTrace.get_values('Am2', combine=False)
-
-    allchiSquared = []
-    for chain in myTrace.chains:
-        chiSquaredList1 = []
-        for counter in np.arange(len(midTArr[chain])):  # [::25]:
-            # first chain
-            midT1 = midTArr[chain][counter]
-            rad1 = radiusArr[chain][counter]
-            am11 = am1Arr[chain][counter]
-            am21 = am2Arr[chain][counter]
-
-            fittedModel1 = lcmodel(midT1, rad1, am11, am21, myTimes, theAirmasses, plots=False)
-            chis1 = np.sum(((myFluxes - fittedModel1) / uncertainty) ** 2.) / (len(myFluxes) - 4)
-            chiSquaredList1.append(chis1)
-        allchiSquared.append(chiSquaredList1)
+    if tracker is None:
+        tracker = Chi2Burn(myFluxes, myTimes, theAirmasses, uncertainty, stride=chi2_burn_stride)
+    tracker.update(samples)
 
     plt.figure()
     plt.xlabel('Chain Length')
     plt.ylabel('Chi^2')
-    for chain in np.arange(myTrace.nchains):
-        plt.plot(np.arange(len(allchiSquared[chain])), allchiSquared[chain], '-bo')
+    for chainplot in tracker.plot:
+        plt.plot([index for index, chi2 in chainplot], [chi2 for index, chi2 in chainplot], '-bo')
     plt.rc('grid', linestyle="-", color='black')
     plt.grid(True)
     plt.title(targetname + ' Chi^2 vs. Chain Length ' + date)
@@ -948,24 +1537,477 @@ def plotChi2Trace(myTrace, myFluxes, myTimes, theAirmasses, uncertainty, targetn
     plt.savefig(infoDict['saveplot'] + 'temp/ChiSquaredTrace' + date + targetname + '.png')
     plt.close()
 
-    chiMedian = np.nanmedian(allchiSquared)
-
-    burns = []
-    for chain in np.arange(myTrace.nchains):
-        idxburn, = np.where(allchiSquared[chain] <= chiMedian)
-        if len(idxburn) == 0:
-            burnno = 0
-        else:
-            burnno = idxburn[0]
-        burns.append(burnno)
-
-    completeBurn = np.max(burns)
+    completeBurn = tracker.burn()
     done = True
     print('Chi^2 Burn In Length: ' + str(completeBurn))
 
     return completeBurn
 
 
+# {name: (nchains, ndraws) array} of every variable in a pymc3 trace, transformed ones included
+def traceArrays(trace):
+    return {key: np.array(trace.get_values(key, combine=False)) for key in trace.varnames}
+
+
+# on disk store of the chains of every variable of model, in directory: one (nchains, ndraws / thin)
+# float32 .npy per variable, stored minus an offset (the model's test point, float32 alone does not
+# resolve a BJD), and trace.json with the offsets, thinning and draws stored per chain
+def createTraceStore(directory, model, nchains, ndraws, thin=1):
+    os.makedirs(directory, exist_ok=True)
+    names = [var.name for var in model.unobserved_RVs]
+    offsets = model.fastfn(model.unobserved_RVs)(model.test_point)
+    store = {'directory': directory, 'arrays': {},
+             'meta': {'offsets': {name: float(offset) for name, offset in zip(names, offsets)},
+                      'thin': thin, 'lengths': [0] * nchains, 'draws': [0] * nchains}}
+    for name in names:
+        store['arrays'][name] = np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+',
+                                                          dtype=np.float32, shape=(nchains, -(-ndraws // thin)))
+    saveTraceStore(store)
+    return store
+
+
+def saveTraceStore(store):
+    for array in store['arrays'].values():
+        array.flush()
+    with open(os.path.join(store['directory'], 'trace.json'), 'w') as metafile:
+        json.dump(store['meta'], metafile)
+
+
+# reopen a trace store read only, as storeChains
+def loadTraceStore(directory):
+    with open(os.path.join(directory, 'trace.json')) as metafile:
+        store = {'directory': directory, 'meta': json.load(metafile), 'arrays': {}}
+    for name in store['meta']['offsets']:
+        store['arrays'][name] = np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')
+    return storeChains(store)
+
+
+# {name: TraceChains} of the draws stored in every chain so far
+def storeChains(store):
+    ndraws = min(store['meta']['lengths'])
+    return {name: TraceChains(array[:, :ndraws], store['meta']['offsets'][name])
+            for name, array in store['arrays'].items()}
+
+
+# (nchains, ndraws) chains of a stored variable; indexing reads only the selected draws from disk
+class TraceChains:
+    def __init__(self, array, offset):
+        self.array = array
+        self.offset = offset
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def __getitem__(self, idx):
+        return np.asarray(self.array[idx], dtype=float) + self.offset
+
+    def __array__(self, dtype=None):
+        return self[:, :] if dtype is None else self[:, :].astype(dtype)
+
+
+# pymc3 backend writing one chain into a trace store: the first tune draws are skipped, then
+# every thin-th draw of the chain goes to the store; the draws are counted in the store across
+# all blocks, so the thinning carries on where the previous block stopped and ndraws draws in
+# any number of blocks fill exactly the ceil(ndraws / thin) columns of createTraceStore
+class MemmapTrace(pm.backends.base.BaseTrace):
+    def __init__(self, store, chain, tune=0, model=None):
+        super().__init__('memmap', model)
+        self.store = store
+        self.chain = chain
+        self.tune = tune
+        self.recorded = 0
+
+    def setup(self, draws, chain, sampler_vars=None):
+        super().setup(draws, chain, sampler_vars)
+        self.recorded = 0
+
+    def record(self, point, sampler_states=None):
+        tuning = self.recorded < self.tune
+        self.recorded += 1
+        if tuning:
+            return
+        meta = self.store['meta']
+        draw = meta['draws'][self.chain]
+        meta['draws'][self.chain] += 1
+        if draw % meta['thin']:
+            return
+        column = draw // meta['thin']
+        for name, value in zip(self.varnames, self.fn(point)):
+            self.store['arrays'][name][self.chain, column] = value - self.store['meta']['offsets'][name]
+        self.store['meta']['lengths'][self.chain] = column + 1
+
+    def close(self):
+        saveTraceStore(self.store)
+
+    def __len__(self):
+        return self.recorded
+
+    # pymc3 takes leading slices of its traces: trace[discard:] at the end of pm.sample (discard = 0,
+    # sampleBlock passes discard_tuned_samples=False) and trace[:length] when the parallel sampler
+    # stops early, to cut the chains to a common length. Those leave the store as it is: its draws
+    # are read with storeChains, which cuts every chain to the shortest one the same way.
+    def _slice(self, idx):
+        if idx.start in (None, 0) and idx.step in (None, 1):
+            return self
+        raise ValueError('MemmapTrace only supports leading slices, read the draws with storeChains')
+
+
+# chains pm.sample runs when not given, max(2, cores) with cores = min(4, cpu count) by default
+def defaultChains(cores=None):
+    return max(2, cores or min(4, os.cpu_count() or 1))
+
+
+# one pm.sample run; without a store returns traceArrays of its draws, with one (createTraceStore)
+# appends them to the chains of the store and returns storeChains of everything stored so far
+def sampleBlock(model, draws, step, tune, start, chains, cores, store=None, **kwargs):
+    if store is None:
+        return traceArrays(pm.sample(draws, step, tune=tune, start=start, chains=chains, cores=cores, **kwargs))
+    nchains = len(store['meta']['lengths'])
+    traces = pm.backends.base.MultiTrace([MemmapTrace(store, chain, tune, model) for chain in range(nchains)])
+    pm.sample(draws, step, tune=tune, start=start, chains=nchains, cores=cores, trace=traces,
+              discard_tuned_samples=False, compute_convergence_checks=False)
+    return storeChains(store)
+
+
+# median and standard deviation of (nchains, ndraws) chains from draw burn on, reading chunk draws
+# of every chain at a time: the mean and variance are merged chunk by chunk, the median is found by
+# narrowing a histogram around the middle rank until the values in its bin fit in one chunk
+def streamingMedianStd(chains, burn=0, chunk=65536):
+    def chunks():
+        for start in range(burn, chains.shape[1], chunk):
+            yield np.ravel(chains[:, start:start + chunk])
+
+    count, mean, sqdev = 0, 0., 0.
+    low, high = np.inf, -np.inf
+    for values in chunks():
+        delta = np.mean(values) - mean
+        sqdev += np.sum((values - np.mean(values)) ** 2) + delta ** 2 * count * values.size / (count + values.size)
+        mean += delta * values.size / (count + values.size)
+        count += values.size
+        low, high = min(low, np.min(values)), max(high, np.max(values))
+
+    # value of the rank-th smallest sample
+    def orderStatistic(rank):
+        lower, upper, below = low, high, 0  # below: number of samples under lower
+        for iteration in range(8):
+            edges = np.linspace(lower, upper, 1025)
+            if not np.all(np.diff(edges) > 0):
+                return lower  # the bin is as narrow as float resolution
+            counts = sum(np.histogram(values, bins=edges)[0] for values in chunks())
+            cumulative = np.cumsum(counts)
+            index = int(np.searchsorted(cumulative, rank - below, side='right'))
+            below += cumulative[index - 1] if index else 0
+            lower, upper = edges[index], edges[index + 1]
+            last = index == len(counts) - 1  # histogram bins are half open but the last
+            if counts[index] <= chunk:
+                inbin = np.concatenate([values[(values >= lower) & ((values <= upper) if last else (values < upper))]
+                                        for values in chunks()])
+                return np.sort(inbin)[rank - below]
+        return lower
+
+    median = orderStatistic((count - 1) // 2)
+    if count % 2 == 0:
+        median = (median + orderStatistic(count // 2)) / 2
+    return float(median), float(np.sqrt(sqdev / count))
+
+
+# split chain Gelman-Rubin statistic of a (nchains, ndraws) array; inf (not converged) if the
+# chains do not move
+def gelmanRubin(chains):
+    half = chains.shape[1] // 2
+    split = np.concatenate([chains[:, :half], chains[:, half:2 * half]])
+    ndraws = split.shape[1]
+    within = np.mean(np.var(split, axis=1, ddof=1))
+    if not within > 0:
+        return np.inf
+    between = ndraws * np.var(np.mean(split, axis=1), ddof=1)
+    return np.sqrt(((ndraws - 1) / ndraws * within + between / ndraws) / within)
+
+
+# effective sample size of a (nchains, ndraws) array, autocorrelations summed in pairs up to
+# the first negative pair (Geyer's initial monotone sequence); 0 (not converged) if the chains
+# do not move
+def effectiveSampleSize(chains):
+    nchains, ndraws = chains.shape
+    nfft = 2 ** int(np.ceil(np.log2(2 * ndraws)))
+    spectrum = np.fft.rfft(chains - np.mean(chains, axis=1, keepdims=True), n=nfft, axis=1)
+    autocov = np.fft.irfft(spectrum * np.conjugate(spectrum), n=nfft, axis=1)[:, :ndraws] / ndraws
+    within = np.mean(autocov[:, 0]) * ndraws / (ndraws - 1)
+    varplus = within * (ndraws - 1) / ndraws
+    if nchains > 1:
+        varplus += np.var(np.mean(chains, axis=1), ddof=1)
+    if not varplus > 0:
+        return 0.
+    rho = 1 - (within - np.mean(autocov, axis=0)) / varplus
+    rho[0] = 1
+    pairs = rho[:ndraws - ndraws % 2:2] + rho[1::2]
+    negative, = np.where(pairs < 0)
+    if len(negative):
+        pairs = pairs[:negative[0]]
+    tau = -1 + 2 * np.sum(np.minimum.accumulate(pairs))
+    return nchains * ndraws / max(tau, 1. / np.log10(nchains * ndraws))
+
+
+# weighted least squares fit of lcmodel from x0 = [Tmid, RpRs, Am1, Am2]; returns the optimum and
+# its covariance, inv(J^T J) with J the Jacobian of the weighted residuals at the optimum
+def lcLeastSquares(x0, theTimes, theFluxes, theUncertainties, theAirmasses):
+    geometry = OrbitGeometry(theTimes, pDict['inc'], pDict['aRs'], pDict['pPer'], pDict['ecc'])
+    low = [np.min(theTimes), 0, -np.inf, -1.0]
+    up = [np.max(theTimes), 1, np.inf, 1.0]
+    x0 = np.clip(x0, low, up)
+
+    def residuals(x):
+        return (theFluxes - lcmodel(x[0], x[1], x[2], x[3], theTimes, theAirmasses, geometry=geometry)) / theUncertainties
+
+    def jacobian(x):
+        return -lcmodel_jac(x[0], x[1], x[2], x[3], theTimes, theAirmasses)[1] / theUncertainties[:, np.newaxis]
+
+    res = least_squares(residuals, x0=x0, jac=jacobian if analytic_jacobian else '2-point', bounds=[low, up],
+                        method='trf')
+    return res.x, np.linalg.pinv(np.dot(res.jac.T, res.jac))
+
+
+# Am1 scales the model linearly; for shapes = model / Am1, one row per parameter set, the mean and
+# variance of Am1 given the data and its (mu, sigma) normal prior; shapes can be a theano tensor
+def am1Conditional(shapes, theFluxes, theUncertainties, prior):
+    weights = 1. / theUncertainties ** 2
+    precision = (shapes ** 2 * weights).sum(axis=-1) + 1. / prior[1] ** 2
+    projection = (shapes * (theFluxes * weights)).sum(axis=-1) + prior[0] / prior[1] ** 2
+    return projection / precision, 1. / precision
+
+
+# log likelihood times the Am1 prior, integrated over Am1, up to a constant; log is np.log, or
+# tt.log for a theano tensor of shapes
+def am1MarginalLogLikelihood(shapes, theFluxes, theUncertainties, prior, log=np.log):
+    mean, variance = am1Conditional(shapes, theFluxes, theUncertainties, prior)
+    chi2 = np.sum((theFluxes / theUncertainties) ** 2) + (prior[0] / prior[1]) ** 2 - mean ** 2 / variance
+    return -0.5 * chi2 + 0.5 * log(variance)
+
+
+# Am1 for every sample of Tmid, RpRs and Am2, drawn from its conditional normal distribution, so
+# the samples follow the joint posterior of all four
+def am1Samples(samples, theTimes, theFluxes, theUncertainties, theAirmasses, prior, chunk=8192):
+    geometry = OrbitGeometry(theTimes, pDict['inc'], pDict['aRs'], pDict['pPer'], pDict['ecc'])
+    midTs, radii, am2s = [np.ravel(samples[key]) for key in ['Tmid', 'RpRs', 'Am2']]
+    am1s = np.empty(midTs.size)
+    for start in range(0, midTs.size, chunk):
+        rows = slice(start, start + chunk)
+        shapes = lcmodel_batch(midTs[rows], radii[rows], 1., am2s[rows], theTimes, theAirmasses, geometry=geometry)
+        mean, variance = am1Conditional(shapes, theFluxes, theUncertainties, prior)
+        am1s[rows] = np.random.normal(mean, np.sqrt(variance))
+    return am1s.reshape(samples['Tmid'].shape)
+
+
+# residuals flux/model - 1 of the comparison star fit for x = [Tmid, RpRs, Am2]: with
+# ratio = flux/(model/Am1) they are ratio/Am1 - 1, least for 1/Am1 = sum(ratio)/sum(ratio^2)
+def am1ProfileResiduals(x, theTimes, theFluxes, theAirmasses, geometry):
+    ratio = theFluxes / lcmodel(x[0], x[1], 1., x[2], theTimes, theAirmasses, geometry=geometry)
+    return ratio * np.sum(ratio) / np.sum(ratio ** 2) - 1.
+
+
+# Jacobian of am1ProfileResiduals, including the change of the best Am1 with x
+def am1ProfileJacobian(x, theTimes, theFluxes, theAirmasses, geometry):
+    shapes, shapesJac = lcmodel_jac(x[0], x[1], 1., x[2], theTimes, theAirmasses)
+    ratio = theFluxes / shapes
+    ratioJac = shapesJac[:, [0, 1, 3]] * (-ratio / shapes)[:, np.newaxis]
+    scale = np.sum(ratio) / np.sum(ratio ** 2)
+    scaleJac = (np.sum(ratioJac, axis=0) - 2 * scale * np.dot(ratio, ratioJac)) / np.sum(ratio ** 2)
+    return scale * ratioJac + np.outer(ratio, scaleJac)
+
+
+# the Am1 that am1ProfileResiduals solves for
+def profiledAm1(x, theTimes, theFluxes, theAirmasses, geometry):
+    ratio = theFluxes / lcmodel(x[0], x[1], 1., x[2], theTimes, theAirmasses, geometry=geometry)
+    return np.sum(ratio ** 2) / np.sum(ratio)
+
+
+# covariance of the least squares fit in the space pymc3 samples, ordered as model.vars; Tmid and
+# RpRs are sampled as logit((x - lower)/(upper - lower)), Am1 and Am2 as they are
+def sampledCovariance(model, best, cov):
+    lower = [model['Tmid'].distribution.lower.eval(), 0., 0., 0.]
+    upper = [model['Tmid'].distribution.upper.eval(), 1., 0., 0.]
+    derivative = np.ones(4)
+    for i in range(2):
+        derivative[i] = (upper[i] - lower[i]) / ((best[i] - lower[i]) * (upper[i] - best[i]))
+    order = [['Tmid', 'RpRs', 'Am1', 'Am2'].index(var.name.split('_')[0]) for var in model.vars]  # without Am1 if marginalized
+    return (cov * np.outer(derivative, derivative))[np.ix_(order, order)]
+
+
+# least squares optimum in the sampled space (Tmid and RpRs log odds transformed, as sampledCovariance),
+# in the order of model.vars; bounded parameters on a bound are moved just inside it
+def sampledPoint(model, best):
+    lower = [model['Tmid'].distribution.lower.eval(), 0.]
+    upper = [model['Tmid'].distribution.upper.eval(), 1.]
+    point = np.array(best, dtype=float)
+    for i in range(2):
+        x = np.clip(point[i], lower[i] + 1e-3 * (upper[i] - lower[i]), upper[i] - 1e-3 * (upper[i] - lower[i]))
+        point[i] = np.log(x - lower[i]) - np.log(upper[i] - x)
+    order = [['Tmid', 'RpRs', 'Am1', 'Am2'].index(var.name.split('_')[0]) for var in model.vars]
+    return point[order]
+
+
+# starting point of every chain, drawn around the least squares optimum from its covariance
+def leastSquaresStarts(model, best, cov, chains):
+    lower = [model['Tmid'].distribution.lower.eval(), 0.]
+    upper = [model['Tmid'].distribution.upper.eval(), 1.]
+    starts = []
+    for chain in range(chains):
+        point = np.random.multivariate_normal(best, cov)
+        for i in range(2):  # stay inside the Tmid and RpRs bounds
+            point[i] = np.clip(point[i], lower[i] + 1e-3 * (upper[i] - lower[i]), upper[i] - 1e-3 * (upper[i] - lower[i]))
+        starts.append({key: value for key, value in zip(['Tmid', 'RpRs', 'Am1', 'Am2'], point) if key in model.named_vars})
+    return starts
+
+
+# step method for a block of the MCMC; given the samples so far, the Metropolis proposal widths
+# or the NUTS mass matrix start from their spread instead of from scratch; for the first block
+# a covariance of the sampled variables (sampledCovariance) and the optimum it is centred on
+# (sampledPoint) can be given instead; Metropolis steps all variables as one block, so every
+# variable is proposed with its own part of the covariance
+def mcmcStep(model, samples=None, cov=None, mean=None):
+    if samples is None and cov is not None:
+        if mcmc_sampler == 'NUTS':
+            potential = pm.step_methods.hmc.quadpotential.QuadPotentialDiagAdapt(
+                len(cov), np.zeros(len(cov)) if mean is None else mean, np.diag(cov), 10)
+            return pm.NUTS(potential=potential)
+        return pm.Metropolis(S=cov, proposal_dist=pm.MultivariateNormalProposal, blocked=True)
+    if samples is None:
+        if mcmc_sampler == 'NUTS':
+            return pm.NUTS()  # gradient based, needs far fewer steps for the same effective sample size
+        return pm.Metropolis()  # Metropolis-Hastings Sampling Technique
+    # sampled space, i.e. transformed variables, in the order of the model
+    values = np.array([np.ravel(samples[var.name]) for var in model.vars])
+    if mcmc_sampler == 'NUTS':
+        potential = pm.step_methods.hmc.quadpotential.QuadPotentialDiagAdapt(
+            len(values), np.mean(values, axis=1), np.var(values, axis=1), 10)
+        return pm.NUTS(potential=potential)
+    return pm.Metropolis(S=np.std(values, axis=1), blocked=True)  # each variable with its own spread
+
+
+# MCMC in blocks of maxLength / mcmc_blocks draws per chain, each block restarting every chain from
+# its last point, until the chains of Tmid, RpRs, Am1 and Am2 pass mcmc_rhat_max and mcmc_ess_min
+# or maxLength draws per chain are reached; returns traceArrays of all blocks joined, or with a
+# trace store (sampleBlock) storeChains of it
+# start, cov and mean, if given, are the starting points, step covariance and its centre (NUTS) of the first block
+# tracker: a Chi2Burn updated after every block
+def sampleUntilConverged(model, maxLength, cores=None, start=None, cov=None, store=None, tracker=None, mean=None):
+    samples = None
+    chains = None if start is None else len(start)
+    blockLength = max(maxLength // mcmc_blocks, 100)
+    ndraws = 0
+    with model:
+        while True:
+            draws = min(blockLength, maxLength - ndraws)
+            block = sampleBlock(model, draws, mcmcStep(model, samples, cov, mean), 500 if samples is None else mcmc_block_tune,
+                                start, chains, cores, store, compute_convergence_checks=False)
+            if samples is None or store is not None:
+                samples = block
+            else:
+                samples = {key: np.concatenate([samples[key], block[key]], axis=1) for key in samples}
+            ndraws += draws
+
+            keys = [key for key in ['Tmid', 'RpRs', 'Am1', 'Am2'] if key in samples]
+            rhat = max(gelmanRubin(np.asarray(samples[key])) for key in keys)
+            ess = min(effectiveSampleSize(np.asarray(samples[key])) for key in keys)
+            print('\n%d draws per chain: max R-hat %.4f, min effective sample size %.0f' % (ndraws, rhat, ess))
+            if tracker is not None:
+                tracker.update(samples)
+                print('Chi^2 burn in so far: %d' % tracker.burn())
+            if rhat <= mcmc_rhat_max and ess >= mcmc_ess_min:
+                break
+            if ndraws >= maxLength:
+                print('Reached the maximum chain length before convergence.')
+                break
+
+            chains = samples['Tmid'].shape[0]
+            start = [{var.name: samples[var.name][chain, -1] for var in model.vars} for chain in range(chains)]
+    return samples
+
+
+# log posterior of the transit fit for a (n, len(names)) array of the parameters in data['names'],
+# [Tmid, RpRs, Am1, Am2] or [Tmid, RpRs, Am2] with Am1 marginalized, with the priors and likelihood
+# of the pymc3 model, for the data of ensembleData
+def ensembleLogProbability(params):
+    data = context['ensemble']
+    point = dict(zip(data['names'], params.T))
+    logp = np.full(len(params), -np.inf)
+    inside = (point['Tmid'] >= data['times'][0]) & (point['Tmid'] <= data['times'][-1]) & \
+             (point['RpRs'] >= 0) & (point['RpRs'] <= 1)
+    if np.any(inside):
+        good = {key: value[inside] for key, value in point.items()}
+        if 'Am1' in good:
+            models = lcmodel_batch(good['Tmid'], good['RpRs'], good['Am1'], good['Am2'], data['times'],
+                                   data['airmasses'], geometry=data['geometry'])
+            logp[inside] = -0.5 * np.sum(((data['fluxes'] - models) / data['uncertainties']) ** 2, axis=1)
+        else:
+            shapes = lcmodel_batch(good['Tmid'], good['RpRs'], 1., good['Am2'], data['times'],
+                                   data['airmasses'], geometry=data['geometry'])
+            logp[inside] = am1MarginalLogLikelihood(shapes, data['fluxes'], data['uncertainties'], data['priors']['Am1'])
+        for key in good:
+            if key in data['priors']:
+                logp[inside] -= 0.5 * ((good[key] - data['priors'][key][0]) / data['priors'][key][1]) ** 2
+    return logp
+
+
+# data: names of the sampled parameters, times, fluxes, uncertainties, airmasses and priors, the
+# (mu, sigma) of RpRs, Am1 and Am2 by name
+def ensembleData(data):
+    context['ensemble'] = dict(data, geometry=OrbitGeometry(data['times'], pDict['inc'], pDict['aRs'],
+                                                            pDict['pPer'], pDict['ecc']))
+
+
+# initializer of the pool processes, which do not run the main block that sets these globals
+def ensembleInit(planet, linear, quad, ldgrid, data):
+    global pDict, linearLimb, quadLimb, context
+    pDict, linearLimb, quadLimb, context = planet, linear, quad, {'ldgrid': ldgrid}
+    ensembleData(data)
+
+
+# walkers: (nwalkers, len(data['names'])) starting points; every step moves one half of the walkers along lines
+# through random walkers of the other half, so each half is a single batched model evaluation
+# returns the chains as traceArrays does, one chain per walker
+def ensembleSample(walkers, nsteps, data, cores=None):
+    nwalkers = len(walkers)
+    processes = min(cores or os.cpu_count() or 1, nwalkers // 2)
+    ensembleData(data)
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, ensembleInit,
+                                    (pDict, linearLimb, quadLimb, context.get('ldgrid'), data))
+
+    def logProbability(params):
+        if pool is None:
+            return ensembleLogProbability(params)
+        return np.concatenate(pool.map(ensembleLogProbability, np.array_split(params, processes)))
+
+    walkers = np.array(walkers, dtype=float)
+    ndim = walkers.shape[1]
+    logp = logProbability(walkers)
+    chains = np.empty((nwalkers, nsteps, ndim))
+    halves = np.array_split(np.arange(nwalkers), 2)
+    accepted = 0
+    try:
+        for step in range(nsteps):
+            for active, other in (halves, halves[::-1]):
+                stretch = ((ensemble_stretch - 1) * np.random.rand(len(active)) + 1) ** 2 / ensemble_stretch
+                partners = walkers[np.random.choice(other, len(active))]
+                proposals = partners + stretch[:, np.newaxis] * (walkers[active] - partners)
+                newlogp = logProbability(proposals)
+                accept = np.log(np.random.rand(len(active))) < (ndim - 1) * np.log(stretch) + newlogp - logp[active]
+                walkers[active[accept]] = proposals[accept]
+                logp[active[accept]] = newlogp[accept]
+                accepted += np.sum(accept)
+            chains[:, step] = walkers
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print('\nEnsemble sampler: %d walkers, %d steps, acceptance fraction %.3f' %
+          (nwalkers, nsteps, accepted / (nwalkers * nsteps)))
+    return {key: chains[:, :, i] for i, key in enumerate(data['names'])}
+
+
 # make plots of the centroid positions as a function of time
 def plotCentroids(xTarg, yTarg, xRef, yRef, times, targetname, date):
     times = np.array(times)
@@ -1033,18 +2075,32 @@ def contextupdt(times=None, airm=None):
 
     if times is not None:
         context['times'] = times
+        context['sep'] = np.empty(np.shape(times))  # reused separation buffer
+        context['geometry'] = OrbitGeometry(times, pDict['inc'], pDict['aRs'], pDict['pPer'], pDict['ecc'])
     if airm is not None:
         context['airmass'] = airm
 
 
 # -- LIGHT CURVE MODEL -- ----------------------------------------------------------------
-def lcmodel(midTran, radi, am1, am2, theTimes, theAirmasses, plots=False):
-    sep, ophase = time2z(theTimes, pDict['inc'], midTran, pDict['aRs'], pDict['pPer'], pDict['ecc'])
-    model, junk = occultquad(abs(sep), linearLimb, quadLimb, radi)
+# limb darkened transit for separations sep, from the occultquad table when one was built
+# radi is a scalar or an array that broadcasts against sep (one radius per row of sep)
+def transitModel(sep, radi):
+    if context.get('ldgrid') is not None:
+        return context['ldgrid'](sep, radi)
+    if np.ndim(radi) == 0:
+        model, junk = occultquad(sep, linearLimb, quadLimb, radi)
+    else:
+        model, junk = occultquad_batch(sep, linearLimb, quadLimb, radi)
+    return model
 
-    airmassModel = (am1 * (np.exp(am2 * theAirmasses)))
-    fittedModel = model * airmassModel
+
+# geometry: OrbitGeometry of theTimes, pass one in when calling repeatedly on the same times
+def lcmodel(midTran, radi, am1, am2, theTimes, theAirmasses, plots=False, geometry=None):
+    if geometry is None:
+        geometry = OrbitGeometry(theTimes, pDict['inc'], pDict['aRs'], pDict['pPer'], pDict['ecc'])
+    fittedModel = lcmodel_batch(midTran, radi, am1, am2, theTimes, theAirmasses, geometry=geometry)[0]
     if plots:
+        sep, ophase = geometry.z(midTran)
         plt.figure()
         plt.plot(ophase, fittedModel, '-o')
         plt.xlabel('Orbital Phase')
@@ -1053,6 +2109,55 @@ def lcmodel(midTran, radi, am1, am2, theTimes, theAirmasses, plots=False):
     return fittedModel
 
 
+# lcmodel in theano tensor operations, differentiable in midTran, radi, am1 and am2
+def lcmodel_tt(midTran, radi, am1, am2, theTimes, theAirmasses):
+    sep = tt_time2z(theTimes, pDict['inc'], midTran, pDict['aRs'], pDict['pPer'], pDict['ecc'])
+    model = tt_occultquad(sep, linearLimb, quadLimb, radi)
+    return model * am1 * tt.exp(am2 * np.asarray(theAirmasses, dtype=float))
+
+
+# lcmodel and its Jacobian with respect to (midTran, radi, am1, am2), from the derivatives of the
+# tensor model; every point depends only on its own time, so the gradient of the summed model with
+# respect to one copy of midTran (radi) per point is the midTran (radi) column of the Jacobian.
+# The model is always the exact one, context['ldgrid'] is not used: with occultquad_grid the Jacobian
+# is only an approximation of that of lcmodel, which the least squares fits tolerate
+def lcmodel_jac(midTran, radi, am1, am2, theTimes, theAirmasses):
+    if context.get('lcjac', (None,))[0] != pDict['ecc']:
+        midTs, radis, times, airms = tt.dvectors('midTs', 'radis', 'times', 'airms')
+        am1s, am2s, inc, aRs, pPer, u1, u2 = tt.dscalars('am1s', 'am2s', 'inc', 'aRs', 'pPer', 'u1', 'u2')
+        sep = tt_time2z(times, inc, midTs, aRs, pPer, pDict['ecc'])
+        airmassModel = tt.exp(am2s * airms)
+        transitAirmass = tt_occultquad(sep, u1, u2, radis) * airmassModel
+        model = am1s * transitAirmass
+        dmidT, dradi = tt.grad(model.sum(), [midTs, radis])
+        context['lcjac'] = (pDict['ecc'], theano.function(
+            [midTs, radis, am1s, am2s, times, airms, inc, aRs, pPer, u1, u2],
+            [model, dmidT, dradi, transitAirmass, model * airms]))
+    npoints = np.size(theTimes)
+    model, dmidT, dradi, dam1, dam2 = context['lcjac'][1](
+        np.full(npoints, midTran, dtype=float), np.full(npoints, radi, dtype=float), am1, am2,
+        np.asarray(theTimes, dtype=float), np.asarray(theAirmasses, dtype=float),
+        pDict['inc'], pDict['aRs'], pDict['pPer'], linearLimb, quadLimb)
+    return model, np.column_stack([dmidT, dradi, dam1, dam2])
+
+
+# light curve models for arrays of (midTran, radi, am1, am2), one row per parameter set
+# the rows are computed chunk at a time, which caps the memory used by the intermediates
+def lcmodel_batch(midTran, radi, am1, am2, theTimes, theAirmasses, geometry=None, chunk=1024):
+    if geometry is None:
+        geometry = OrbitGeometry(theTimes, pDict['inc'], pDict['aRs'], pDict['pPer'], pDict['ecc'])
+    midTran, radi, am1, am2 = np.broadcast_arrays(*[np.atleast_1d(np.asarray(param, dtype=float))
+                                                    for param in (midTran, radi, am1, am2)])
+    theAirmasses = np.asarray(theAirmasses, dtype=float)
+    models = np.empty((midTran.size, np.size(theTimes)))
+    for start in range(0, midTran.size, chunk):
+        rows = slice(start, start + chunk)
+        sep, ophase = geometry.z(midTran[rows])
+        models[rows] = transitModel(np.abs(sep, out=sep), radi[rows, np.newaxis])
+        models[rows] *= am1[rows, np.newaxis] * np.exp(am2[rows, np.newaxis] * theAirmasses)
+    return models
+
+
 def realTimeReduce(i):
     targetFluxVals = []
     referenceFluxVals = []
@@ -1128,7 +2233,7 @@ def realTimeReduce(i):
         # ---FLUX CALCULATION WITH BACKGROUND SUBTRACTION---------------------------------
 
         # corrects for any image shifts that result from a tracking slip
-        shift, error, diffphase = phase_cross_correlation(prevImageData, imageData)
+        shift = registerShift(prevImageData, imageData, [(prevTPX, prevTPY), (prevRPX, prevRPY)])
         xShift = shift[1]
         yShift = shift[0]
 
@@ -1670,6 +2775,11 @@ if __name__ == "__main__":
         print('Linear Term: ' + linearString)
         print('Quadratic Term: ' + quadString)
 
+        if occultquad_grid:
+            context['ldgrid'] = OccultquadGrid(linearLimb, quadLimb, pmax=max(0.5, 2 * pDict['rprs']),
+                                               cachedir=occultquad_cachedir)
+            print('Transit model table error (estimate): %.1e' % context['ldgrid'].maxerr)
+
         if fitsortext == 1:
             print('\n**************************')
             print('Starting Reduction Process')
@@ -1858,6 +2968,22 @@ if __name__ == "__main__":
             maxAperture = int(5 * max(targsigX, targsigY) + 1)
             minAnnulus = 2
             maxAnnulus = 5
+
+            # fit the comparison stars in the first image to determine priors to be used later
+            compFirstFits = fit_centroids([firstImageData] * len(compStarList), compStarList, box=10)
+
+            # frame shifts and target and comparison star centroids, shared by every comparison star and aperture
+            frameShifts, starFits = registerFrames(sortedallImageData,
+                                                   [(UIprevTPX, UIprevTPY, targsigX, targsigY)] +
+                                                   [(x, y, fit[3], fit[4]) for (x, y), fit in zip(compStarList, compFirstFits)],
+                                                   distFC)
+            # a large jump between two frames points to a tracking slip worth checking in the images
+            frameDrift = np.hypot(*np.transpose(frameShifts))
+            print('Largest shift between consecutive frames: %.1f pixels (frame %d)'
+                  % (np.max(frameDrift), np.argmax(frameDrift)))
+            targetFits = starFits[0]
+            targetPhotometry = {}
+
             # exit()
             # fit centroids for first image to determine priors to be used later
             for compCounter in range(0, len(compStarList)):
@@ -1868,11 +2994,8 @@ if __name__ == "__main__":
                 # #just in case comp star drifted off and timeSortedNames had to be altered, reset it for the new comp star
                 # timeSortedNames = tsnCopy
 
-                UIprevRPX, UIprevRPY = compStarList[compCounter]
-
                 print('Target X: ' + str(round(targx)) + ' Target Y: ' + str(round(targy)))
-                refx, refy, refamplitude, refsigX, refsigY, retrot, refoff = fit_centroid(firstImageData, [UIprevRPX, UIprevRPY],
-                                                                                box=10)
+                refx, refy, refamplitude, refsigX, refsigY, retrot, refoff = compFirstFits[compCounter]
                 print('Comparison X: ' + str(round(refx)) + ' Comparison Y: ' + str(round(refy)) + '\n')
 
                 # determines the aperture and annulus combinations to iterate through based on the sigmas of the LM fit
@@ -1889,11 +3012,10 @@ if __name__ == "__main__":
                 annulus_step = np.nanmax([1, (annulus_max - annulus_min)//5])  # forces step size to be at least 1
                 annulus_sizes = [5] # np.arange(annulus_min, annulus_max, annulus_step) # TODO clean up for issue #40
 
-                target_fits = {}
-                ref_fits = {}
-                reg_trans = {}
+                refFits = starFits[compCounter + 1]
+                refPhotometry = {}
 
-                for apertureR in aperture_sizes:  # aperture loop
+                for apertureIndex, apertureR in enumerate(aperture_sizes):  # aperture loop
                     for annulusR in annulus_sizes:  # annulus loop # no need
                         # fileNumber = 1
                         print('Testing Comparison Star #' + str(compCounter+1) + ' with a '+str(apertureR)+' pixel aperture and a '+str(annulusR)+' pixel annulus.')
@@ -1904,42 +3026,13 @@ if __name__ == "__main__":
 
                             # header = fits.getheader(imageFile)
 
-                            # Find the target star in the image and get its pixel coordinates if it is the first file
-                            if fileNumber == 0:
-                                # Initializing the star location guess as the user inputted pixel coordinates
-                                prevTPX, prevTPY, prevRPX, prevRPY = UIprevTPX, UIprevTPY, UIprevRPX, UIprevRPY  # 398, 275, 419, 203
-                                prevTSigX, prevTSigY, prevRSigX, prevRSigY = targsigX, targsigY, refsigX, refsigY
-                                prevImageData = imageData  # no shift should be registered
-
                             # ------ CENTROID FITTING ----------------------------------------
 
-                            # corrects for any image shifts that result from a tracking slip
-                            # shift, error, diffphase = phase_cross_correlation(prevImageData, imageData)
-                            if fileNumber in reg_trans.keys():
-                                shift, error, diffphase = reg_trans[fileNumber]
-                            else:
-                                shift, error, diffphase = phase_cross_correlation(prevImageData, imageData)
-                                reg_trans[fileNumber] = [shift, error, diffphase]
-
-                            xShift = shift[1]
-                            yShift = shift[0]
-
-                            prevTPX = prevTPX - xShift
-                            prevTPY = prevTPY - yShift
-                            prevRPX = prevRPX - xShift
-                            prevRPY = prevRPY - yShift
-
-                            # set target search area
-                            txmin = int(prevTPX) - distFC  # left
-                            txmax = int(prevTPX) + distFC  # right
-                            tymin = int(prevTPY) - distFC  # top
-                            tymax = int(prevTPY) + distFC  # bottom
-
                             # boolean that represents if either the target or comp star gets too close to the detector
                             driftBool = False
 
                             #check if your target star is too close to the edge of the detector
-                            if txmin <= 0 or tymin <= 0 or txmax >= len(imageData) or tymax >= len(imageData[0]):
+                            if fileNumber >= len(targetFits):
                                 print('*************************************************************************************')
                                 print('WARNING: In image '+str(fileNumber)+', your target star has drifted too close to the edge of the detector.')
                                 #tooClose = int(input('Enter "1" to pick a new comparison star or enter "2" to continue using the same comp star, with the images with all the remaining images ignored \n'))
@@ -1948,14 +3041,8 @@ if __name__ == "__main__":
 
                                 # mask off the rest of timeSortedNames and then ignore the rest of the procedure until
 
-                            # Set reference search area
-                            rxmin = int(prevRPX) - distFC  # left
-                            rxmax = int(prevRPX) + distFC  # right
-                            rymin = int(prevRPY) - distFC  # top
-                            rymax = int(prevRPY) + distFC  # bottom
-
-                            # check if the reference is too close to the edge of the detector
-                            if rxmin <= 0 or rymin <= 0 or rxmax >= len(imageData[0]) or rymax >= len(imageData):
+                            # check if the reference is too close to the edge of the detector (registerFrames)
+                            elif refFits[fileNumber] is None:
                                 print('*************************************************************************************')
                                 print('WARNING: In image '+str(fileNumber)+', your reference star has drifted too close to the edge of the detector.')
                                 #tooClose = int(input('Enter "1" to pick a new comparison star or enter "2" to continue using the same comp star, with the images with all the remaining images ignored \n'))
@@ -1965,42 +3052,8 @@ if __name__ == "__main__":
 
                             # if the star isn't too close, then proceed as normal
                             if not driftBool:
-                                targSearchA = imageData[tymin:tymax, txmin:txmax]
-                                refSearchA = imageData[rymin:rymax, rxmin:rxmax]
-
-                                targPos = [prevTPX, prevTPY]
-
-                                # get minimum background value bigger than 0
-                                targImFlat = np.sort(np.array(targSearchA).ravel())
-
-                                # Initialize the variable
-                                tGuessBkg = 0
-                                for el in targImFlat:
-                                    if el > 0:
-                                        tGuessBkg = el
-                                        break
-
-                                refImFlat = np.sort(np.array(refSearchA).ravel())
-                                for rel in refImFlat:
-                                    if rel > 0:
-                                        rGuessBkg = rel
-                                        break
-
-                                # Guess at Gaussian Parameters and feed them in to help gaussian fitter
-
-                                tGuessAmp = targSearchA.max() - tGuessBkg
-                                if tGuessAmp < 0:
-                                    print('Error: the Darks have a higher pixel counts than the image itself')
-                                myPriors = [tGuessAmp, prevTSigX, prevTSigY, 0, tGuessBkg]
-
-                                # tx, ty, tamplitude, tsigX, tsigY, toff = fit_centroid(imageData, targPos,
-                                #                                                     init=myPriors, box=distFC)
-                                if fileNumber in target_fits.keys():
-                                    tx, ty, tamplitude, tsigX, tsigY, toff = target_fits[fileNumber]
-                                else:
-                                    tx, ty, tamplitude, tsigX, tsigY, trot, toff = fit_centroid(imageData, targPos,
-                                                                                          init=myPriors, box=distFC)
-                                    target_fits[fileNumber] = [tx, ty, tamplitude, tsigX, tsigY, toff]
+                                # target and reference centroids, fitted once per frame by registerFrames
+                                tx, ty, tamplitude, tsigX, tsigY, trot, toff = targetFits[fileNumber]
 
                                 currTPX = tx
                                 currTPY = ty
@@ -2009,16 +3062,7 @@ if __name__ == "__main__":
                                 xTargCent.append(currTPX)
                                 yTargCent.append(currTPY)
 
-                                rGuessAmp = refSearchA.max() - rGuessBkg
-                                myRefPriors = [rGuessAmp, prevRSigX, prevRSigY, 0, rGuessBkg]
-                                # rx, ry, ramplitude, rsigX, rsigY, roff = fit_centroid(imageData, [prevRPX, prevRPY],
-                                # init=myRefPriors, box=distFC)
-                                if fileNumber in ref_fits.keys():
-                                    rx, ry, ramplitude, rsigX, rsigY, roff = ref_fits[fileNumber]
-                                else:
-                                    rx, ry, ramplitude, rsigX, rsigY, rrot, roff = fit_centroid(imageData, [prevRPX, prevRPY],
-                                                                                          init=myRefPriors, box=distFC)
-                                    ref_fits[fileNumber] = [rx, ry, ramplitude, rsigX, rsigY, roff]
+                                rx, ry, ramplitude, rsigX, rsigY, rrot, roff = refFits[fileNumber]
                                 currRPX = rx
                                 currRPY = ry
 
@@ -2035,15 +3079,25 @@ if __name__ == "__main__":
                                 else:
                                     # ------FLUX CALCULATION WITH BACKGROUND SUBTRACTION----------------------------------
 
+                                    # the target and reference star are measured in every aperture of aperture_sizes in
+                                    # one pass (getFluxes) the first time an image is reached with an annulus, and the
+                                    # target fluxes are shared by all comparison stars
+                                    if (fileNumber, annulusR) not in targetPhotometry:
+                                        targetPhotometry[fileNumber, annulusR] = getFluxes(imageData, currTPX, currTPY,
+                                                                                           aperture_sizes, annulusR)
+                                    if (fileNumber, annulusR) not in refPhotometry:
+                                        refPhotometry[fileNumber, annulusR] = getFluxes(imageData, currRPX, currRPY,
+                                                                                        aperture_sizes, annulusR)
+
                                     # gets the flux value of the target star and subtracts the background light
-                                    tFluxVal, tTotCts = getFlux(imageData, currTPX, currTPY, apertureR, annulusR)
+                                    tFluxVal, tTotCts = [fluxes[apertureIndex] for fluxes in targetPhotometry[fileNumber, annulusR]]
                                     # FIXME centroid position is way off from user input for star
 
                                     targetFluxVals.append(tFluxVal)  # adds tFluxVal to the total list of flux values of target star
                                     targUncertanties.append(np.sqrt(tFluxVal))  # uncertanty on each point is the sqrt of the total counts
 
                                     # gets the flux value of the reference star and subracts the background light
-                                    rFluxVal, rTotCts = getFlux(imageData, currRPX, currRPY, apertureR, annulusR)
+                                    rFluxVal, rTotCts = [fluxes[apertureIndex] for fluxes in refPhotometry[fileNumber, annulusR]]
 
                                     referenceFluxVals.append(
                                         rFluxVal)  # adds rFluxVal to the total list of flux values of reference star
@@ -2061,20 +3115,7 @@ if __name__ == "__main__":
                                     # airMass = getAirMass(hDul)  # gets the airmass at the time the image was taken
                                     # airMassList.append(airMass)  # adds that airmass value to the list of airmasses
 
-                                    # UPDATE PIXEL COORDINATES and SIGMAS
-                                    # target
-                                    prevTPX = currTPX
-                                    prevTPY = currTPY
-                                    prevTSigX = tsigX
-                                    prevTSigY = tsigY
-                                    # reference
-                                    prevRPX = currRPX
-                                    prevRPY = currRPY
-                                    prevRSigX = rsigX
-                                    prevTSigY = rsigY
-
                                 # UPDATE FILE COUNT
-                                prevImageData = imageData
                                 # fileNumber = fileNumber + 1
                                 # hDul.close()  # close the stream
 
@@ -2139,28 +3180,48 @@ if __name__ == "__main__":
                         low = [arrayTimes[0], 0, -np.inf, -1.0]
                         bound = [low, up]
 
+                        # orbital geometry of the unclipped times, shared by every evaluation of the fit
+                        lcGeometry = OrbitGeometry(arrayTimes[~filtered_data.mask], pDict['inc'], pDict['aRs'],
+                                                   pDict['pPer'], pDict['ecc'])
+
                         # define residual function to be minimized
                         def lc2min(x):
                             gaelMod = lcmodel(x[0], x[1], x[2], x[3], arrayTimes[~filtered_data.mask],
-                                            arrayAirmass[~filtered_data.mask], plots=False)
+                                            arrayAirmass[~filtered_data.mask], plots=False, geometry=lcGeometry)
                             # airMod= ( x[2]*(np.exp(x[3]*arrayAirmass[~filtered_data.mask])))
                             # return arrayFinalFlux[~filtered_data.mask]/airMod - gaelMod/airMod
                             return (arrayFinalFlux[~filtered_data.mask] / gaelMod) - 1.
 
-
-                        res = least_squares(lc2min, x0=initvals, bounds=bound, method='trf')  # results of least squares fit
+                        # Jacobian of lc2min, d(flux/model)/dx = -flux/model^2 dmodel/dx
+                        def lc2jac(x):
+                            gaelMod, modelJac = lcmodel_jac(x[0], x[1], x[2], x[3], arrayTimes[~filtered_data.mask],
+                                                            arrayAirmass[~filtered_data.mask])
+                            return modelJac * (-arrayFinalFlux[~filtered_data.mask] / gaelMod ** 2)[:, np.newaxis]
+
+                        if marginalize_am1:
+                            # Am1 in closed form, fit Tmid, RpRs and Am2 only
+                            profileArgs = (arrayTimes[~filtered_data.mask], arrayFinalFlux[~filtered_data.mask],
+                                           arrayAirmass[~filtered_data.mask], lcGeometry)
+                            res = least_squares(am1ProfileResiduals, x0=np.delete(initvals, 2),
+                                                jac=am1ProfileJacobian if analytic_jacobian else '2-point',
+                                                bounds=[np.delete(low, 2), np.delete(up, 2)], args=profileArgs, method='trf')
+                            fitParams = np.insert(res.x, 2, profiledAm1(res.x, *profileArgs))
+                        else:
+                            res = least_squares(lc2min, x0=initvals, jac=lc2jac if analytic_jacobian else '2-point',
+                                                bounds=bound, method='trf')  # results of least squares fit
+                            fitParams = res.x
 
                         # Calculate the standard deviation of the residuals
                         residualVals = res.fun
                         standardDev2 = np.std(residualVals, dtype=np.float64)  # calculates standard deviation of data
 
-                        lsFit = lcmodel(res.x[0], res.x[1], res.x[2], res.x[3], arrayTimes[~filtered_data.mask],
-                                        arrayAirmass[~filtered_data.mask], plots=False)
+                        lsFit = lcmodel(fitParams[0], fitParams[1], fitParams[2], fitParams[3], arrayTimes[~filtered_data.mask],
+                                        arrayAirmass[~filtered_data.mask], plots=False, geometry=lcGeometry)
 
                         # compute chi^2 from least squares fit
                         # print('Median Uncertainty Value: '+ str(round(np.median(arrayNormUnc),5)))
                         chi2_init = np.sum(((arrayFinalFlux[~filtered_data.mask] - lsFit) / arrayNormUnc[~filtered_data.mask]) ** 2.) / (
-                                len(arrayFinalFlux[~filtered_data.mask]) - len(res.x))
+                                len(arrayFinalFlux[~filtered_data.mask]) - len(fitParams))
                         # print("Non-Reduced chi2: ",np.sum(((arrayFinalFlux[~filtered_data.mask]-lsFit)/arrayNormUnc)**2.))
 
                         # chi2 = np.sum(((arrayFinalFlux[~filtered_data.mask]-lsFit)/arrayNormUnc)**2.)/(len(arrayFinalFlux[~filtered_data.mask])-len(res.x)-1)
@@ -2170,6 +3231,7 @@ if __name__ == "__main__":
                         if minSTD > standardDev2:  # If the standard deviation is less than the previous min
                             bestCompStar = compCounter + 1
                             minSTD = standardDev2  # set the minimum standard deviation to that
+                            bestLSFit = fitParams  # Tmid in JD, see bjdOffset
 
                             arrayNormUnc = arrayNormUnc * np.sqrt(chi2_init)  # scale errorbars by sqrt(chi2) so that chi2 == 1
                             minAnnulus = annulusR  # then set min aperature and annulus to those values
@@ -2215,6 +3277,9 @@ if __name__ == "__main__":
                     # Exit aperture loop
                 # Exit annulus loop
             # Exit the Comp Stars Loop
+            print('\nAperture weight cache: ' + str(apertureWeights.hits) + ' of ' +
+                  str(apertureWeights.hits + apertureWeights.misses) + ' lookups hit (' +
+                  str(round(apertureWeights.hitRate() * 100, 1)) + '%)')
             print('\n*********************************************')
             print('Best Comparison Star: #' + str(bestCompStar))
             print('Minimum Residual Scatter: ' + str(round(minSTD * 100, 4)) + '%')
@@ -2315,6 +3380,7 @@ if __name__ == "__main__":
                 resultos = utc_tdb.JDUTC_to_BJDTDB(nonBJDTimes, ra=pDict['ra'], dec=pDict['dec'], lat=lati, longi=longit, alt=infoDict['elev'])
                 goodTimes = resultos[0]
                 done = True
+            bjdOffset = np.median(goodTimes - nonBJDTimes)  # BJD - JD, to carry bestLSFit over
 
             # Centroid position plots
             plotCentroids(finXTargCent, finYTargCent, finXRefCent, finYRefCent, goodTimes, pDict['pName'], infoDict['date'])
@@ -2458,8 +3524,8 @@ if __name__ == "__main__":
             tranTime, pRad, amc1, amc2 = specparams
 
             # lightcurve model
-            sep, ophase = time2z(context['times'], pDict['inc'], float(tranTime), pDict['aRs'], pDict['pPer'], pDict['ecc'])
-            gmodel, garb = occultquad(abs(sep), linearLimb, quadLimb, float(pRad))
+            sep, ophase = context['geometry'].z(float(tranTime), out=context['sep'])
+            gmodel = transitModel(np.abs(sep, out=sep), float(pRad))
 
             # exponential airmass model
             airmassModel = (float(amc1) * (np.exp(float(amc2) * context['airmass'])))
@@ -2468,76 +3534,129 @@ if __name__ == "__main__":
             return completeModel
 
 
-        # initialize pymc3 sampler using gael model
-        nodes = []
-        lcMod = pm.Model()
-        with lcMod:
-
-            # PRIORS
-            ### Double check these priors
-            # BoundedNormal = pm.Bound(pm.Normal, lower=extractTime - 3 * planetPeriod / 4, upper=extractTime + 3 * planetPeriod / 4)  # ###get the transit duration
-            midT = pm.Uniform('Tmid', upper=goodTimes[len(goodTimes) - 1], lower=goodTimes[0])
-            BoundedNormal2 = pm.Bound(pm.Normal, lower=0, upper=1)
-            radius = BoundedNormal2('RpRs', mu=extractRad, tau=1.0 / (sigRad ** 2))
-            airmassCoeff1 = pm.Normal('Am1', mu=np.median(goodFluxes), tau=1.0 / (sigOff ** 2))
-            airmassCoeff2 = pm.Normal('Am2', mu=amC2Guess, tau=1.0 / (sigC2 ** 2))
-
-            # append to list of parameters
-            nodes.append(midT)
-            nodes.append(radius)
-            nodes.append(airmassCoeff1)
-            nodes.append(airmassCoeff2)
-
-            # OBSERVATION MODEL
-            obs = pm.Normal('obs', mu=gaelModel(*nodes), tau=1. / (goodNormUnc ** 2.), observed=goodFluxes)
-
-        # Sample from the model
-        final_chain_length = int(100000)
+        # weighted least squares fit, the MCMC starting point or with uncertainty_method = 'Laplace' the result
+        if mcmc_ls_start or mcmc_sampler == 'ensemble' or uncertainty_method == 'Laplace':
+            if fitsortext == 1:
+                lsStart = [bestLSFit[0] + bjdOffset, bestLSFit[1], bestLSFit[2], bestLSFit[3]]
+            else:
+                lsStart = [np.median(goodTimes), pDict['rprs'], np.median(goodFluxes), 0]
+            lsBest, lsCov = lcLeastSquares(lsStart, goodTimes, goodFluxes, goodNormUnc, goodAirmasses)
+            print('\nLeast squares fit: Tmid = %.6f, RpRs = %.5f, Am1 = %.5f, Am2 = %.5f' % tuple(lsBest))
+
+        if uncertainty_method == 'Laplace':
+            # the posterior approximated by a normal distribution at the least squares optimum, with the
+            # inverse of the Fisher matrix J^T J as covariance
+            fitMidT, fitRadius, fitAm1, fitAm2 = [float(value) for value in lsBest]
+            midTranUncert, radUncert, am1Uncert, am2Uncert = [round(float(np.sqrt(variance)), 6) for variance in np.diag(lsCov)]
+        else:
+            # initialize pymc3 sampler using gael model
+            nodes = []
+            lcMod = pm.Model()
+            with lcMod:
+
+                # PRIORS
+                ### Double check these priors
+                # BoundedNormal = pm.Bound(pm.Normal, lower=extractTime - 3 * planetPeriod / 4, upper=extractTime + 3 * planetPeriod / 4)  # ###get the transit duration
+                midT = pm.Uniform('Tmid', upper=goodTimes[len(goodTimes) - 1], lower=goodTimes[0])
+                BoundedNormal2 = pm.Bound(pm.Normal, lower=0, upper=1)
+                radius = BoundedNormal2('RpRs', mu=extractRad, tau=1.0 / (sigRad ** 2))
+                if marginalize_am1:
+                    airmassCoeff1 = tt.as_tensor_variable(np.float64(1.))  # the model divided by Am1
+                else:
+                    airmassCoeff1 = pm.Normal('Am1', mu=np.median(goodFluxes), tau=1.0 / (sigOff ** 2))
+                airmassCoeff2 = pm.Normal('Am2', mu=amC2Guess, tau=1.0 / (sigC2 ** 2))
+
+                # append to list of parameters
+                nodes.append(midT)
+                nodes.append(radius)
+                nodes.append(airmassCoeff1)
+                nodes.append(airmassCoeff2)
+
+                # OBSERVATION MODEL
+                if mcmc_sampler == 'NUTS':
+                    lightCurve = lcmodel_tt(midT, radius, airmassCoeff1, airmassCoeff2, goodTimes, goodAirmasses)
+                else:
+                    lightCurve = gaelModel(*nodes)
+                if marginalize_am1:
+                    obs = pm.Potential('obs', am1MarginalLogLikelihood(lightCurve, goodFluxes, goodNormUnc,
+                                                                       (np.median(goodFluxes), sigOff), log=tt.log))
+                else:
+                    obs = pm.Normal('obs', mu=lightCurve, tau=1. / (goodNormUnc ** 2.), observed=goodFluxes)
 
-        with lcMod:
-            step = pm.Metropolis()  # Metropolis-Hastings Sampling Technique
+            # Sample from the model
+            if mcmc_sampler == 'NUTS':
+                final_chain_length = nuts_chain_length
+            else:
+                final_chain_length = int(100000)
             if "Windows" in platform.system():
-                trace = pm.sample(final_chain_length, step, chains=None, cores=1) # For some reason, Windows machines do not like using multi-cores with pymc3....
+                cores = 1  # For some reason, Windows machines do not like using multi-cores with pymc3....
+            else:
+                cores = None
+
+            start, stepCov, stepMean = None, None, None
+            if mcmc_ls_start and mcmc_sampler != 'ensemble':
+                start = leastSquaresStarts(lcMod, lsBest, lsCov, defaultChains(cores))
+                stepCov = sampledCovariance(lcMod, lsBest, lsCov)
+                stepMean = sampledPoint(lcMod, lsBest)
+
+            store = None
+            if mcmc_trace_store and mcmc_sampler != 'ensemble':
+                store = createTraceStore(infoDict['saveplot'] + 'temp/Trace' + pDict['pName'] + infoDict['date'], lcMod,
+                                         defaultChains(cores) if start is None else len(start), final_chain_length, mcmc_thin)
+
+            tracker = None
+            if mcmc_sampler == 'ensemble':
+                # walkers start in a small ball around the least squares optimum
+                names = ['Tmid', 'RpRs', 'Am2'] if marginalize_am1 else ['Tmid', 'RpRs', 'Am1', 'Am2']
+                walkers = [[point[key] for key in names]
+                           for point in leastSquaresStarts(lcMod, lsBest, lsCov / 100., ensemble_walkers)]
+                ensembleInputs = {'names': names, 'times': goodTimes, 'fluxes': goodFluxes, 'uncertainties': goodNormUnc,
+                                  'airmasses': goodAirmasses,
+                                  'priors': {'RpRs': (extractRad, sigRad), 'Am1': (np.median(goodFluxes), sigOff),
+                                             'Am2': (amC2Guess, sigC2)}}
+                samples = ensembleSample(walkers, ensemble_steps, ensembleInputs, ensemble_cores)
+            elif mcmc_adaptive:
+                # without Am1 in the chains the chi squared waits for am1Samples below
+                tracker = None if marginalize_am1 else Chi2Burn(goodFluxes, goodTimes, goodAirmasses, goodNormUnc,
+                                                                stride=chi2_burn_stride)
+                samples = sampleUntilConverged(lcMod, final_chain_length, cores, start=start, cov=stepCov, store=store,
+                                               tracker=tracker, mean=stepMean)
             else:
-                trace = pm.sample(final_chain_length, step, chains=None, cores=None)
-
-        # ----Plot the Results from the MCMC -------------------------------------------------------------------
-        print('\n******************************************')
-        print('MCMC Diagnostic Tests and Chi Squared Burn\n')
-
-        # ChiSquared Trace to determine burn in length
-        burn = plotChi2Trace(trace, goodFluxes, goodTimes, goodAirmasses, goodNormUnc, pDict['pName'], infoDict['date'])
-
-        # OUTPUTS
-        fitMidTArray = trace['Tmid', burn:]
-        fitRadiusArray = trace['RpRs', burn:]
-
-        fitMidT = float(np.median(trace['Tmid', burn:]))
-        fitRadius = float(np.median(trace['RpRs', burn:]))
-        fitAm1 = float(np.median(trace['Am1', burn:]))
-        fitAm2 = float(np.median(trace['Am2', burn:]))
-
-        midTranUncert = round(np.std(trace['Tmid', burn:]), 6)
-        radUncert = round(np.std(trace['RpRs', burn:]), 6)
-        am1Uncert = round(np.std(trace['Am1', burn:]), 6)
-        am2Uncert = round(np.std(trace['Am2', burn:]), 6)
-
-        # Plot Traces
-        for keyi in trace.varnames:
-            if "interval" not in keyi:
-                plt.plot(trace[keyi, burn:])
-                plt.title(keyi)
-                plt.savefig(infoDict['saveplot'] + 'temp/Traces' + pDict['pName'] + infoDict['date'] + "_" + keyi + '.png')
-                plt.close()
-
-        # # Gelman Rubin
-        # print("Gelman Rubin Convergence Test:")
-        # print(pm.gelman_rubin(trace))
-
-        # TODO set the MCMC chain length low, then run a gelman_rubin(trace) to see if <=1.1
-        # (RTZ will probably make this 1.01 to be safe)
-        # if they are not below this value, then run more chains
-        # Hopefully this will keep the code running for less time
+                with lcMod:
+                    samples = sampleBlock(lcMod, final_chain_length, mcmcStep(lcMod, cov=stepCov, mean=stepMean), 500, start,
+                                          None if start is None else len(start), cores, store)
+            if marginalize_am1:
+                samples['Am1'] = am1Samples(samples, goodTimes, goodFluxes, goodNormUnc, goodAirmasses,
+                                            (np.median(goodFluxes), sigOff))
+
+            # ----Plot the Results from the MCMC -------------------------------------------------------------------
+            print('\n******************************************')
+            print('MCMC Diagnostic Tests and Chi Squared Burn\n')
+
+            # ChiSquared Trace to determine burn in length
+            burn = plotChi2Trace(samples, goodFluxes, goodTimes, goodAirmasses, goodNormUnc, pDict['pName'], infoDict['date'],
+                                 tracker=tracker)
+
+            # OUTPUTS
+            # every chain from the burn in on, summarized without loading the chains at once
+            fitMidT, midTranUncert = streamingMedianStd(samples['Tmid'], burn)
+            fitRadius, radUncert = streamingMedianStd(samples['RpRs'], burn)
+            fitAm1, am1Uncert = streamingMedianStd(samples['Am1'], burn)
+            fitAm2, am2Uncert = streamingMedianStd(samples['Am2'], burn)
+
+            midTranUncert = round(midTranUncert, 6)
+            radUncert = round(radUncert, 6)
+            am1Uncert = round(am1Uncert, 6)
+            am2Uncert = round(am2Uncert, 6)
+
+            # Plot Traces, every chain from the burn in on, joined, at most ~100000 points
+            stride = max(1, samples['Tmid'].shape[0] * (samples['Tmid'].shape[1] - burn) // 100000)
+            for keyi in samples:
+                if "interval" not in keyi:
+                    plt.plot(np.ravel(samples[keyi][:, burn::stride]))
+                    plt.title(keyi)
+                    plt.savefig(infoDict['saveplot'] + 'temp/Traces' + pDict['pName'] + infoDict['date'] + "_" + keyi + '.png')
+                    plt.close()
 
         fittedModel = lcmodel(fitMidT, fitRadius, fitAm1, fitAm2, goodTimes, goodAirmasses, plots=False)
         airmassMo = (fitAm1 * (np.exp(fitAm2 * goodAirmasses)))
@@ -2686,6 +3805,10 @@ if __name__ == "__main__":
         plt.close()
 
         # print final extracted planetary parameters
+        if uncertainty_method == 'Laplace':
+            uncertaintyNote = 'Laplace approximation (least squares covariance), no MCMC'
+        else:
+            uncertaintyNote = 'MCMC (' + mcmc_sampler + ')'
 
         print('*********************************************************')
         print('FINAL PLANETARY PARAMETERS')
@@ -2693,10 +3816,11 @@ if __name__ == "__main__":
         print('The fitted Ratio of Planet to Stellar Radius is: ' + str(fitRadius) + ' +/- ' + str(
             radUncert) + ' (Rp/Rs)')
         print('The transit depth uncertainty is: ' + str(
-            100 * 2 * fitRadius * round(np.std(trace['RpRs', burn:]), 6)) + ' (%)')
+            100 * 2 * fitRadius * radUncert) + ' (%)')
         print('The fitted airmass1 is: ' + str(fitAm1) + ' +/- ' + str(am1Uncert))
         print('The fitted airmass2 is: ' + str(fitAm2) + ' +/- ' + str(am2Uncert))
         print('The scatter in the residuals of the lightcurve fit is: ' + str(round(100 * correctedSTD, 3)) + ' (%)')
+        print('The uncertainty method is: ' + uncertaintyNote)
         print('\n*********************************************************')
 
         ##########
@@ -2711,11 +3835,12 @@ if __name__ == "__main__":
         outParamsFile.write('The fitted Ratio of Planet to Stellar Radius is: ' + str(fitRadius) + ' +/- ' + str(
             radUncert) + ' (Rp/Rs)\n')
         outParamsFile.write('The transit depth uncertainty is: ' + str(
-            2 * 100 * fitRadius * round(np.std(trace['RpRs', burn:]), 6)) + ' (%)\n')
+            2 * 100 * fitRadius * radUncert) + ' (%)\n')
         outParamsFile.write('The fitted airmass1 is: ' + str(fitAm1) + ' +/- ' + str(am1Uncert) + '\n')
         outParamsFile.write('The fitted airmass2 is: ' + str(fitAm2) + ' +/- ' + str(am2Uncert) + '\n')
         outParamsFile.write(
             'The scatter in the residuals of the lightcurve fit is: ' + str(round(100 * correctedSTD, 3)) + '%\n')
+        outParamsFile.write('The uncertainty method is: ' + uncertaintyNote + '\n')
         outParamsFile.close()
         print('\nFinal Planetary Parameters have been saved in ' + infoDict['saveplot'] + ' as '
               + pDict['pName'] + infoDict['date'] + '.txt' + '\n')
@@ -2737,7 +3862,10 @@ if __name__ == "__main__":
         outParamsFile.write('#BINNING=' + infoDict['pixelbin'] + '\n')  # user input
         outParamsFile.write('#EXPOSURE_TIME=' + str(infoDict['exposure']) + '\n')  # UI
         outParamsFile.write('#FILTER=' + infoDict['filter'] + '\n')
-        outParamsFile.write('#NOTES=' + infoDict['notes'] + '\n')
+        if uncertainty_method == 'Laplace':
+            outParamsFile.write('#NOTES=' + infoDict['notes'] + ' [' + uncertaintyNote + ']\n')
+        else:
+            outParamsFile.write('#NOTES=' + infoDict['notes'] + '\n')
         outParamsFile.write('#DETREND_PARAMETERS=AIRMASS, AIRMASS CORRECTION FUNCTION\n')  # fixed
         outParamsFile.write('#MEASUREMENT_TYPE=Rnflux\n')  # fixed
         # outParamsFile.write('#PRIORS=Period=' + str(planetPeriod) + ' +/- ' + str(ogPeriodErr) + ',a/R*=' + str(
@@ -2,9 +2,11 @@
 import numpy as np
 # ------------- ------------------------------------------------------
 # -- TIME TO Z -- ----------------------------------------------------
-def time2z(time, ipct, tknot, sma, orbperiod, ecc, tperi=None, epsilon=1e-5):
+def time2z(time, ipct, tknot, sma, orbperiod, ecc, tperi=None, epsilon=1e-5,
+           out=None):
     '''
 G. ROUDIER: Time samples in [Days] to separation in [R*]
+out: optional preallocated array with the shape of time, receives z
     '''
     if tperi is not None:
         ft0 = (tperi - tknot) % orbperiod
@@ -14,7 +16,7 @@ G. ROUDIER: Time samples in [Days] to separation in [R*]
         E0 = solveme(M0, ecc, epsilon)
         realf = np.sqrt(1e0 - ecc)*np.cos(E0/2e0)
         imagf = np.sqrt(1e0 + ecc)*np.sin(E0/2e0)
-        w = np.angle(np.complex(realf, imagf))
+        w = np.arctan2(imagf, realf)
         if abs(ft0) < epsilon:
             w = np.pi/2e0
             tperi = tknot
@@ -30,34 +32,121 @@ G. ROUDIER: Time samples in [Days] to separation in [R*]
     sft[(sft > 0.5)] += -1e0
     M = 2e0*np.pi*ft
     E = solveme(M, ecc, epsilon)
-    realf = np.sqrt(1. - ecc)*np.cos(E/2e0)
-    imagf = np.sqrt(1. + ecc)*np.sin(E/2e0)
-    f = []
-    for r, i in zip(realf, imagf):
-        cn = np.complex(r, i)
-        f.append(2e0*np.angle(cn))
-        pass
-    f = np.array(f)
-    r = sma*(1e0 - ecc**2)/(1e0 + ecc*np.cos(f))
-    z = r*np.sqrt(1e0**2 - (np.sin(w+f)**2)*(np.sin(ipct*np.pi/180e0))**2)
+    E /= 2e0
+    f = np.sqrt(1e0 - ecc)*np.cos(E)
+    np.sin(E, out=E)
+    E *= np.sqrt(1e0 + ecc)
+    np.arctan2(E, f, out=f)
+    f *= 2e0
+    if out is None: out = np.empty(f.shape)
+    z = out
+    np.add(w, f, out=z)
+    np.sin(z, out=z)
+    np.square(z, out=z)
+    z *= -(np.sin(ipct*np.pi/180e0))**2
+    z += 1e0
+    np.sqrt(z, out=z)
+    z *= sma*(1e0 - ecc**2)
+    np.cos(f, out=f)
+    f *= ecc
+    f += 1e0
+    z /= f
     z[sft < 0] *= -1e0
     return z, sft
 # --------------- ----------------------------------------------------
+# -- CACHED ORBITAL GEOMETRY -- --------------------------------------
+class OrbitGeometry:
+    '''
+Time samples in [Days] to separation in [R*] for a fixed orbit
+Everything that does not depend on the mid transit time is computed
+once, z(tknot) returns the same (z, sft) as
+time2z(time, ipct, tknot, sma, orbperiod, ecc)
+ecc == 0 uses the closed form z = sma*sqrt(1 - cos(M)**2 sin(i)**2)
+tknot can be an array of mid transit times, z then has one row per tknot
+    '''
+    def __init__(self, time, ipct, sma, orbperiod, ecc, epsilon=1e-5):
+        self.time = np.array(time, dtype=float)
+        self.sma = sma
+        self.orbperiod = orbperiod
+        self.ecc = ecc
+        self.epsilon = epsilon
+        self.circular = ecc == 0
+        self.sin2i = (np.sin(ipct*np.pi/180e0))**2
+        self.semilatus = sma*(1e0 - ecc**2)
+        self.realfac = np.sqrt(1e0 - ecc)
+        self.imagfac = np.sqrt(1e0 + ecc)
+        pass
+    def z(self, tknot, out=None):
+        '''
+Separation for mid transit time tknot, out receives z if given
+        '''
+        if np.ndim(tknot) > 0: tknot = np.reshape(tknot, (-1, 1))
+        ft = self.time - tknot
+        np.mod(ft, self.orbperiod, out=ft)
+        ft /= self.orbperiod
+        sft = np.copy(ft)
+        sft[(sft > 0.5)] += -1e0
+        if out is None: out = np.empty(ft.shape)
+        z = out
+        if self.circular:
+            np.multiply(ft, 2e0*np.pi, out=z)
+            np.cos(z, out=z)
+            np.square(z, out=z)
+            z *= -self.sin2i
+            z += 1e0
+            np.sqrt(z, out=z)
+            z *= self.sma
+            pass
+        else:
+            E = solveme(2e0*np.pi*ft, self.ecc, self.epsilon)
+            E /= 2e0
+            np.cos(E, out=ft)
+            ft *= self.realfac
+            np.sin(E, out=E)
+            E *= self.imagfac
+            f = np.arctan2(E, ft, out=ft)
+            f *= 2e0
+            np.cos(f, out=z)
+            np.square(z, out=z)
+            z *= -self.sin2i
+            z += 1e0
+            np.sqrt(z, out=z)
+            z *= self.semilatus
+            np.cos(f, out=f)
+            f *= self.ecc
+            f += 1e0
+            z /= f
+            pass
+        z[sft < 0] *= -1e0
+        return z, sft
+    pass
+# ------------------------------ -------------------------------------
 # -- TRUE ANOMALY NEWTON RAPHSON SOLVER -- ---------------------------
-def solveme(M, e, eps):
+def solveme(M, e, eps=1e-5, maxiter=int(64)):
     '''
 G. ROUDIER: Newton Raphson solver for true anomaly
-M is a numpy array
+M is a numpy array of any shape or a scalar
+The whole array is iterated at once, elements that satisfy
+abs(E - e*sin(E) - M) <= eps drop out of the working set.
+The starting point M + 0.85*e*sign(sin(M)) (Danby 1988) keeps
+the iteration stable up to e ~ 0.95
     '''
-    E = np.copy(M)
-    for i in np.arange(M.shape[0]):
-        while abs(E[i] - e*np.sin(E[i]) - M[i]) > eps:
-            num = E[i] - e*np.sin(E[i]) - M[i]
-            den = 1. - e*np.cos(E[i])
-            E[i] = E[i] - num/den
-            pass
+    scalar = np.ndim(M) == 0
+    shape = np.shape(M)
+    M = np.array(M, dtype=float, ndmin=1).ravel()
+    E = M + 0.85*e*np.sign(np.sin(M))
+    todo = np.arange(M.size)
+    for _ in range(maxiter):
+        Etodo = E[todo]
+        num = Etodo - e*np.sin(Etodo) - M[todo]
+        select = np.abs(num) > eps
+        if not select.any(): break
+        todo = todo[select]
+        Etodo = Etodo[select]
+        E[todo] = Etodo - num[select]/(1e0 - e*np.cos(Etodo))
         pass
-    return E
+    if scalar: return E[0]
+    return E.reshape(shape)
 # ---------------------------------------- ---------------------------
 # -- TRANSIT LIMB DARKENED LIGHT CURVE -- ----------------------------
 def tldlc(z, rprs, g1=0, g2=0, g3=0, g4=0, nint=int(2**3)):
@@ -1,4 +1,9 @@
-from numpy import size,zeros,where,arccos,sqrt,pi,log
+from numpy import size,zeros,where,arccos,sqrt,pi,log,ones,empty,arange,\
+    atleast_1d,absolute,divide,multiply,asarray,broadcast_arrays,\
+    linspace,minimum,maximum,unique,isfinite,load,savez,\
+    concatenate
+import os
+import hashlib
 
 # Computes Hasting's polynomial approximation for the complete
 # elliptic integral of the first (ek) and second (kk) kind
@@ -36,18 +41,42 @@ def ellke(k):
 
 # Computes the complete elliptical integral of the third kind using
 # the algorithm of Bulirsch (1965):
-def ellpic_bulirsch(n,k):
-    kc=sqrt(1.-k**2); la=n+1.
+# Each element leaves the working set as soon as it converges and the
+# recurrence is updated in place. With stats=True the iteration counts
+# are returned as well: iterations (passes over the working set),
+# evaluations (element updates) and size (number of elements)
+def ellpic_bulirsch(n,k,stats=False):
+    kc=atleast_1d(sqrt(1.-k**2)); la=atleast_1d(n+1.)
+    # k = 1 (z = 1-p exactly) has kc = 0, the recurrence never converges
+    kc[kc < 1.e-14]=1.e-14
     if(min(la) < 0.):
         print('Negative l')
-    m0=1.; c=1.; la=sqrt(la); d=1./la; e=kc
+    nk=size(kc); out=zeros(nk); todo=arange(nk)
+    m0=ones(nk); c=ones(nk); la=sqrt(la); d=1./la; e=kc.copy()
+    f=empty(nk); g=empty(nk); tmp=empty(nk)
+    iterations=0; evaluations=0
     while 1:
-        f = c; c = d/la+c; g = e/la; d = 2.*(f*g+d)
-        la = g + la; g = m0; m0 = kc + m0
-        if max(abs(1.-kc/g)) > 1.e-8:
-            kc = 2*sqrt(e); e=kc*m0
-        else:
-            return 0.5*pi*(c*m0+d)/(m0*(m0+la))
+        iterations+=1; evaluations+=size(todo)
+        f[:]=c; divide(d,la,out=tmp); c+=tmp; divide(e,la,out=g)
+        f*=g; d+=f; d*=2.
+        la+=g; g[:]=m0; m0+=kc
+        divide(kc,g,out=tmp); tmp-=1.; absolute(tmp,out=tmp)
+        # NaN elements stop here too, as in the original max() test
+        conv = ~(tmp > 1.e-8)
+        if conv.any():
+            out[todo[conv]] = 0.5*pi*(c[conv]*m0[conv]+d[conv])/\
+                              (m0[conv]*(m0[conv]+la[conv]))
+            keep = ~conv
+            if not keep.any():
+                break
+            todo=todo[keep]; kc=kc[keep]; la=la[keep]; m0=m0[keep]
+            c=c[keep]; d=d[keep]; e=e[keep]
+            f=f[keep]; g=g[keep]; tmp=tmp[keep]
+        sqrt(e,out=kc); kc*=2.; multiply(kc,m0,out=e)
+    if stats:
+        return out, {'iterations': iterations, 'evaluations': evaluations,
+                     'size': nk}
+    return out
 
 #   Python translation of IDL code.
 #   This routine computes the lightcurve for occultation of a
@@ -249,7 +278,7 @@ def occultquad(z,u1,u2,p0):
         ## if there are still unused elements, there's a bug in the code
         ## (please report it)
         notused5 = where(z[notusedyet] > (1.-p))
-        if notused5[0] != 0:
+        if size(notused5) != 0:
             print("ERROR: the following values of z didn't fit into a case:")
             return [-1,-1]
 
@@ -257,3 +286,222 @@ def occultquad(z,u1,u2,p0):
                   u2*etad)/omega
         mu0=1.-lambdae
         return [muo1,mu0]
+
+
+# occultquad for arrays of separations z and planet radii p0 of any
+# shapes that broadcast together, e.g. z of shape (nsample, ntime) with
+# p0 of shape (nsample, 1). Each element goes through the same cases as
+# in occultquad, selected with boolean masks instead of one p at a time.
+def occultquad_batch(z,u1,u2,p0):
+
+    z,p=broadcast_arrays(asarray(z,dtype=float),absolute(asarray(p0,
+                                                                dtype=float)))
+    shape=z.shape
+    z=z.ravel().copy(); p=p.ravel()
+    nz = size(z)
+    lambdad = zeros(nz)
+    etad = zeros(nz)
+    lambdae = zeros(nz)
+    omega=1.-u1/3.-u2/6.
+    tol = 1e-14
+
+    z = where(abs(p-z) < tol,p,z)
+    z = where(abs((p-1)-z) < tol,p-1.,z)
+    z = where(abs((1-p)-z) < tol,1.-p,z)
+    z = where(z < tol,0.,z)
+
+    x1=(p-z)**2.
+    x2=(p+z)**2.
+    x3=p**2.-z**2.
+
+    ## Case 1 - the star is unocculted, and the trivial case of no planet
+    todo = (z < 1.+p) & (p > 0.)
+
+    # Case 11 - the  source is completely occulted:
+    occulted = todo & (p >= 1.) & (z <= p-1.)
+    etad[occulted] = 0.5
+    lambdae[occulted] = 1.
+    todo &= ~occulted
+
+    # Case 2, 7, 8 - ingress/egress (uniform disk only)
+    sel = todo & (z >= abs(1.-p))
+    if sel.any():
+        zs=z[sel]; ps=p[sel]
+        tmp = (1.-ps**2.+zs**2.)/2./zs
+        kap1 = arccos(minimum(maximum(tmp,-1.),1.))
+        tmp = (ps**2.+zs**2-1.)/2./ps/zs
+        kap0 = arccos(minimum(maximum(tmp,-1.),1.))
+        tmp = maximum(4.*zs**2-(1.+zs**2-ps**2)**2,0.)
+        lambdae[sel] = (ps**2*kap0+kap1 - 0.5*sqrt(tmp))/pi
+        # eta_1
+        etad[sel] = 1./2./pi*(kap1+ps**2*(ps**2+2.*zs**2)*kap0- \
+           (1.+5.*ps**2+zs**2)/4.*sqrt((1.-x1[sel])*(x2[sel]-1.)))
+
+    # Case 5, 6, 7 - the edge of planet lies at origin of star
+    ocltor = todo & (z == p)
+    if ocltor.any():
+        sel = ocltor & (p < 0.5)
+        if sel.any():
+            # Case 5
+            ps=p[sel]
+            Ek,Kk = ellke(2.*ps)
+            # lambda_4
+            lambdad[sel] = 1./3.+2./9./pi*(4.*(2.*ps**2-1.)*Ek+\
+                                           (1.-4.*ps**2)*Kk)
+            # eta_2
+            etad[sel] = ps**2/2.*(ps**2+2.*z[sel]**2)
+            lambdae[sel] = ps**2 # uniform disk
+        sel = ocltor & (p > 0.5)
+        if sel.any():
+            # Case 7
+            ps=p[sel]
+            Ek,Kk = ellke(0.5/ps)
+            # lambda_3
+            lambdad[sel] = 1./3.+16.*ps/9./pi*(2.*ps**2-1.)*Ek-\
+                           (32.*ps**4-20.*ps**2+3.)/9./pi/ps*Kk
+        sel = ocltor & (p == 0.5)
+        # Case 6
+        lambdad[sel] = 1./3.-4./pi/9.
+        etad[sel] = 3./32.
+        todo &= ~ocltor
+
+    # Case 2, Case 8 - ingress/egress (with limb darkening)
+    sel = todo & ( ((z > 0.5+abs(p-0.5)) & (z < 1.+p)) | \
+                   ((p > 0.5) & (z > abs(1.-p)) & (z < p)) )
+    if sel.any():
+        q=sqrt((1.-x1[sel])/(x2[sel]-x1[sel]))
+        Ek,Kk = ellke(q)
+        n=1./x1[sel]-1.
+        # lambda_1:
+        lambdad[sel]=2./9./pi/sqrt(x2[sel]-x1[sel])*\
+                     (((1.-x2[sel])*(2.*x2[sel]+x1[sel]-3.)-\
+                       3.*x3[sel]*(x2[sel]-2.))*Kk+(x2[sel]-\
+                       x1[sel])*(z[sel]**2+7.*p[sel]**2-4.)*Ek-\
+                      3.*x3[sel]/x1[sel]*ellpic_bulirsch(n,q))
+        todo &= ~sel
+
+    # Case 3, 4, 9, 10 - planet completely inside star
+    inside = todo & (p < 1.) & (z <= 1.-p)
+    if inside.any():
+        ps=p[inside]
+        ## eta_2
+        etad[inside] = ps**2/2.*(ps**2+2.*z[inside]**2)
+        ## uniform disk
+        lambdae[inside] = ps**2
+
+        ## Case 4 - edge of planet hits edge of star
+        edge = inside & (z == 1.-p)
+        if edge.any():
+            ps=p[edge]
+            ## lambda_5
+            lambdad[edge] = 2./3./pi*arccos(1.-2.*ps)-\
+                            4./9./pi*sqrt(ps*(1.-ps))*(3.+2.*ps-8.*ps**2)-\
+                            2./3.*(ps > 0.5)
+            inside &= ~edge
+
+        ## Case 10 - origin of planet hits origin of star
+        origin = inside & (z == 0)
+        ## lambda_6
+        lambdad[origin] = -2./3.*(1.-p[origin]**2)**1.5
+        inside &= ~origin
+
+        ## Case 3, Case 9 - anywhere in between
+        if inside.any():
+            q=sqrt((x2[inside]-x1[inside])/(1.-x1[inside]))
+            n=x2[inside]/x1[inside]-1.
+            Ek,Kk = ellke(q)
+            ## lambda_2
+            lambdad[inside] = 2./9./pi/sqrt(1.-x1[inside])*\
+                              ((1.-5.*z[inside]**2+p[inside]**2+\
+                                x3[inside]**2)*Kk+(1.-x1[inside])*\
+                               (z[inside]**2+7.*p[inside]**2-4.)*Ek-\
+                               3.*x3[inside]/x1[inside]*\
+                               ellpic_bulirsch(n,q))
+
+    muo1 =1.-((1.-u1-2.*u2)*lambdae+(u1+2.*u2)*(lambdad+2./3.*(p > z))+\
+              u2*etad)/omega
+    mu0=1.-lambdae
+    return [muo1.reshape(shape),mu0.reshape(shape)]
+
+# Tabulated occultquad for limb darkening coefficients that stay fixed
+# during a fit. muo1 is computed once on a regular grid of npgrid planet
+# radii in [pmin, pmax] and nzgrid separations in [0, 1+pmax]; lookups
+# interpolate bilinearly. maxerr estimates the error of the table: the
+# largest |interpolated - occultquad| measured when the table is built,
+# over the centres of all grid cells and densely around the contact points
+# z = 1 -+ p, where muo1 has kinks between the nodes and the interpolation
+# error peaks (~1e-5 with the default grid for typical u1, u2). It is an
+# estimate, not a bound. Radii outside [pmin, pmax] are passed to occultquad.
+# With cachedir set the table is saved there, keyed by (u1, u2, grid),
+# and later runs with the same coefficients load it instead.
+class OccultquadGrid:
+
+    def __init__(self,u1,u2,pmin=0.,pmax=0.5,npgrid=201,nzgrid=3001,
+                 cachedir=None):
+        self.u1=float(u1); self.u2=float(u2)
+        self.pmin=float(pmin); self.pmax=float(pmax)
+        self.npgrid=int(npgrid); self.nzgrid=int(nzgrid)
+        self.zmax=1.+self.pmax
+        self.dp=(self.pmax-self.pmin)/(self.npgrid-1)
+        self.dz=self.zmax/(self.nzgrid-1)
+
+        spec=(self.u1,self.u2,self.pmin,self.pmax,self.npgrid,self.nzgrid,
+              'kinks')
+        key=hashlib.sha1(repr(spec).encode()).hexdigest()[:16]
+        cachefile=None
+        if cachedir:
+            cachefile=os.path.join(cachedir,'occultquad_'+key+'.npz')
+            if os.path.exists(cachefile):
+                cached=load(cachefile)
+                self.table=cached['table']; self.maxerr=float(cached['maxerr'])
+                return
+
+        pgrid=linspace(self.pmin,self.pmax,self.npgrid)
+        zgrid=linspace(0.,self.zmax,self.nzgrid)
+        self.table=empty((self.npgrid,self.nzgrid))
+        for j,p in enumerate(pgrid):
+            self.table[j]=occultquad(zgrid,self.u1,self.u2,p)[0]
+            # z = 1-p falls on a node for some p, where muo1 is 0/0
+            bad=~isfinite(self.table[j])
+            if bad.any():
+                self.table[j][bad]=occultquad(zgrid[bad]-1e-9,self.u1,self.u2,
+                                              p)[0]
+
+        # error estimate from the cell centres and from 81 separations
+        # within two cells of each contact point, for radii on and between
+        # the nodes
+        zmid=zgrid[:-1]+0.5*self.dz
+        near=linspace(-2.*self.dz,2.*self.dz,81)
+        self.maxerr=0.
+        for k,p in enumerate(concatenate([pgrid,pgrid[:-1]+0.5*self.dp])):
+            zk=concatenate([1.-p+near,1.+p+near])
+            zk=zk[(zk>=0.)&(zk<=self.zmax)]
+            z=concatenate([zmid,zk]) if k>=self.npgrid else zk
+            err=absolute(self(z,p)-occultquad(z,self.u1,self.u2,p)[0])
+            err=err[isfinite(err)]
+            if err.size:
+                self.maxerr=max(self.maxerr,err.max())
+
+        if cachefile:
+            os.makedirs(cachedir,exist_ok=True)
+            savez(cachefile,table=self.table,maxerr=self.maxerr)
+
+    # muo1 for separations z and planet radii p (scalar or same shape as z)
+    def __call__(self,z,p):
+        z,p=broadcast_arrays(absolute(asarray(z,dtype=float)),
+                             asarray(p,dtype=float))
+        muo1=ones(z.shape)
+        ingrid=(p >= self.pmin) & (p <= self.pmax)
+        select=ingrid & (z < self.zmax)
+        x=z[select]/self.dz
+        i=minimum(x.astype(int),self.nzgrid-2); t=x-i
+        y=(p[select]-self.pmin)/self.dp
+        j=minimum(y.astype(int),self.npgrid-2); s=y-j
+        tab=self.table
+        muo1[select]=(1.-s)*((1.-t)*tab[j,i]+t*tab[j,i+1])+\
+                     s*((1.-t)*tab[j+1,i]+t*tab[j+1,i+1])
+        if not ingrid.all():
+            for pout in unique(p[~ingrid]):
+                select=p == pout
+                muo1[select]=occultquad(z[select],self.u1,self.u2,pout)[0]
+        return muo1
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('theano')
+exotic = pytest.importorskip('exotic')
+
+
+@pytest.fixture(params=[0.0, 0.1])
+def planet(request, monkeypatch):
+    monkeypatch.setattr(exotic, 'pDict', {'inc': 88., 'aRs': 8., 'pPer': 3.1, 'ecc': request.param}, raising=False)
+    monkeypatch.setattr(exotic, 'linearLimb', 0.4, raising=False)
+    monkeypatch.setattr(exotic, 'quadLimb', 0.25, raising=False)
+    monkeypatch.setattr(exotic, 'context', {}, raising=False)
+
+
+# the Jacobian of lcmodel_jac must match central differences of lcmodel, over a night covering
+# both the ingress and the egress of the transit
+def test_jacobian_matches_finite_differences(planet):
+    times = np.linspace(99.9, 100.1, 300)
+    airmasses = np.linspace(1.1, 1.5, 300)
+    x = np.array([100.003, 0.12, 1.01, 0.02])
+
+    model, jacobian = exotic.lcmodel_jac(*x, times, airmasses)
+    np.testing.assert_allclose(model, exotic.lcmodel(*x, times, airmasses), rtol=1e-9)
+
+    h = 1e-6
+    for k in range(4):
+        up, down = x.copy(), x.copy()
+        up[k] += h
+        down[k] -= h
+        differences = (exotic.lcmodel(*up, times, airmasses) - exotic.lcmodel(*down, times, airmasses)) / (2 * h)
+        assert np.max(np.abs(differences)) > 0
+        assert np.max(np.abs(jacobian[:, k] - differences)) < 1e-4 * np.max(np.abs(differences))
@@ -0,0 +1,56 @@
+import numpy as np
+import pytest
+
+theano = pytest.importorskip('theano')
+tt = pytest.importorskip('theano.tensor')
+from gaelLCFuncs import time2z
+from occultquad import occultquad
+from theanoLCFuncs import tt_time2z, tt_occultquad
+
+u1, u2 = 0.4, 0.25
+
+
+# separations covering the full transit, the ingress/egress and out of transit, with the planet
+# over the centre of the star (p > z) and the points next to z = p and z = 1 - p
+def separations(p):
+    edges = [p, 1 - p, 1 + p]
+    offsets = [-1e-3, -1e-5, -1e-8, 0., 1e-8, 1e-5, 1e-3]
+    return np.sort(np.concatenate([np.linspace(0., 1.5, 301), [0., p / 2]] +
+                                  [np.add(edge, offsets) for edge in edges]))
+
+
+@pytest.mark.parametrize('ecc', [0., 0.3])
+def test_time2z_matches_gael(ecc):
+    times = np.linspace(99., 101., 2001)
+    tknot = tt.dscalar('tknot')
+    z = theano.function([tknot], tt_time2z(times, 88., tknot, 8., 3.1, ecc))(100.01)
+    np.testing.assert_allclose(z, np.abs(time2z(times, 88., 100.01, 8., 3.1, ecc)[0]), rtol=1e-9, atol=1e-9)
+
+
+@pytest.mark.parametrize('p', [0.1, 0.7])
+def test_occultquad_matches_mandel_agol(p):
+    z = separations(p)
+    zs, ps = tt.dvector('zs'), tt.dscalar('ps')
+    model = theano.function([zs, ps], tt_occultquad(zs, u1, u2, ps))(z, p)
+    expected = occultquad(z, u1, u2, p)[0]
+    assert np.all(np.isfinite(model))
+    # points within tol = 1e-6 of z = p or z = 1 - p are evaluated at the edge + tol
+    np.testing.assert_allclose(model, expected, rtol=0, atol=1e-5)
+    away = np.min(np.abs(z[:, np.newaxis] - [p, 1 - p]), axis=1) > 1e-4
+    np.testing.assert_allclose(model[away], expected[away], rtol=0, atol=1e-9)
+
+
+# gradients of the tensor model against finite differences, away from the points the cases switch at
+@pytest.mark.parametrize('p', [0.1, 0.7])
+def test_occultquad_gradient(p):
+    z = np.array([0.05, 0.25, 0.5, 0.9, 1.05])
+    z = z[np.min(np.abs(z[:, np.newaxis] - [p, 1 - p, 1 + p]), axis=1) > 1e-2]
+    theano.gradient.verify_grad(lambda zs, ps: tt_occultquad(zs, u1, u2, ps), [z, np.asarray(p)],
+                                rng=np.random.RandomState(0))
+
+
+@pytest.mark.parametrize('ecc', [0., 0.3])
+def test_time2z_gradient(ecc):
+    times = np.linspace(99.9, 100.1, 11)
+    theano.gradient.verify_grad(lambda tknot: tt_time2z(times, 88., tknot, 8., 3.1, ecc), [np.asarray(100.003)],
+                                rng=np.random.RandomState(0))
@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+pm = pytest.importorskip('pymc3')
+exotic = pytest.importorskip('exotic')
+
+
+# ten blocks of 17 draws, thinned by 3, must fill the ceil(170 / 3) = 57 columns of the store
+# exactly: thinning each block on its own needs 6 columns per block, 60 in all
+def test_thinned_blocks_fill_the_store(tmp_path):
+    with pm.Model() as model:
+        pm.Normal('x', mu=1., sigma=1.)
+    store = exotic.createTraceStore(str(tmp_path), model, 2, 170, thin=3)
+    with model:
+        for block in range(10):
+            chains = exotic.sampleBlock(model, 17, pm.Metropolis(), 5, None, 2, 1, store)
+
+    assert store['meta']['draws'] == [170, 170]
+    assert store['meta']['lengths'] == [57, 57]
+    assert chains['x'].shape == (2, 57)
+    assert np.all(np.isfinite(chains['x'][:, :]))
+    assert exotic.loadTraceStore(str(tmp_path))['x'].shape == (2, 57)
+
+
+# the same with the chains sampled in two processes, through pymc3's parallel sampler
+def test_thinned_blocks_fill_the_store_in_parallel(tmp_path):
+    with pm.Model() as model:
+        pm.Normal('x', mu=1., sigma=1.)
+    store = exotic.createTraceStore(str(tmp_path), model, 2, 170, thin=3)
+    with model:
+        for block in range(10):
+            chains = exotic.sampleBlock(model, 17, pm.Metropolis(), 5, None, 2, 2, store)
+
+    assert store['meta']['draws'] == [170, 170]
+    assert store['meta']['lengths'] == [57, 57]
+    assert chains['x'].shape == (2, 57)
+    assert np.all(np.isfinite(chains['x'][:, :]))
@@ -0,0 +1,177 @@
+# -- IMPORTS -- ------------------------------------------------------
+import numpy as np
+import theano
+import theano.tensor as tt
+from gaelLCFuncs import solveme
+# ------------- ------------------------------------------------------
+# Theano tensor versions of time2z (gaelLCFuncs) and occultquad
+# (occultquad) for 0 < p < 1, so the light curve model has gradients.
+# Every case is evaluated for all points and the result picked with
+# tt.switch; points that do not belong to a case are replaced by a
+# value that is valid for it, otherwise NaN derivatives of the unused
+# branch leak into the gradient.
+# -- KEPLER EQUATION -- ----------------------------------------------
+class KeplerOp(theano.Op):
+    '''
+Eccentric anomaly E from mean anomaly M for eccentricity ecc
+The values come from gaelLCFuncs.solveme, the gradient from
+dE/dM = 1/(1 - ecc*cos(E))
+    '''
+    __props__ = ('ecc', 'epsilon')
+    def __init__(self, ecc, epsilon=1e-5):
+        self.ecc = float(ecc)
+        self.epsilon = float(epsilon)
+        super().__init__()
+        pass
+    def make_node(self, M):
+        M = tt.as_tensor_variable(M)
+        return theano.Apply(self, [M], [M.type()])
+    def perform(self, node, inputs, outputs):
+        outputs[0][0] = np.asarray(solveme(inputs[0], self.ecc, self.epsilon),
+                                   dtype=node.outputs[0].dtype)
+        pass
+    def grad(self, inputs, gradients):
+        E = self(inputs[0])
+        return [gradients[0]/(1e0 - self.ecc*tt.cos(E))]
+    pass
+# -------------------- -----------------------------------------------
+# -- TIME TO Z -- ----------------------------------------------------
+def tt_time2z(time, ipct, tknot, sma, orbperiod, ecc, epsilon=1e-5):
+    '''
+Time samples in [Days] to |separation| in [R*]
+ecc is a number, the other arguments numbers or tensors
+Same as abs(OrbitGeometry(time, ipct, sma, orbperiod, ecc).z(tknot)[0])
+ecc == 0 uses the closed form
+    '''
+    time = tt.as_tensor_variable(time)
+    sin2i = tt.sin(ipct*np.pi/180e0)**2
+    ft = tt.mod(time - tknot, orbperiod)/orbperiod
+    M = 2e0*np.pi*ft
+    if ecc == 0:
+        z = sma*tt.sqrt(1e0 - tt.cos(M)**2*sin2i)
+        return z
+    E = KeplerOp(ecc, epsilon)(M)
+    f = 2e0*tt.arctan2(np.sqrt(1e0 + ecc)*tt.sin(E/2e0),
+                       np.sqrt(1e0 - ecc)*tt.cos(E/2e0))
+    z = sma*(1e0 - ecc**2)*tt.sqrt(1e0 - tt.cos(f)**2*sin2i)
+    z /= 1e0 + ecc*tt.cos(f)
+    return z
+# --------------- ----------------------------------------------------
+# -- COMPLETE ELLIPTIC INTEGRALS -- ----------------------------------
+def tt_ellke(k):
+    '''
+Hasting's approximation of the complete elliptic integrals
+of the second (ek) and first (kk) kind, 0 <= k < 1
+    '''
+    m1 = 1e0 - k**2
+    logm1 = tt.log(m1)
+    ee1 = 1e0 + m1*(0.44325141463 + m1*(0.06260601220 +
+                                         m1*(0.04757383546 +
+                                             m1*0.01736506451)))
+    ee2 = m1*(0.24998368310 + m1*(0.09200180037 +
+                                   m1*(0.04069697526 +
+                                       m1*0.00526449639)))*(-logm1)
+    ek1 = 1.38629436112 + m1*(0.09666344259 + m1*(0.03590092383 +
+                                                   m1*(0.03742563713 +
+                                                       m1*0.01451196212)))
+    ek2 = (0.5 + m1*(0.12498593597 + m1*(0.06880248576 +
+                                         m1*(0.03328355346 +
+                                             m1*0.00441787012))))*logm1
+    return ee1 + ee2, ek1 - ek2
+
+def tt_ellpic_bulirsch(n, k, niter=int(10)):
+    '''
+Complete elliptic integral of the third kind (Bulirsch 1965)
+The loop is unrolled niter times, elements stop updating once
+abs(1 - kc/m0) <= 1e-8 as in occultquad.ellpic_bulirsch
+    '''
+    kc = tt.sqrt(1e0 - k**2)
+    la = tt.sqrt(n + 1e0)
+    m0 = tt.ones_like(kc)
+    c = tt.ones_like(kc)
+    d = 1e0/la
+    e = kc
+    out = tt.zeros_like(kc)
+    done = tt.zeros_like(kc) > 1e0
+    for _ in range(niter):
+        newc = d/la + c
+        g = e/la
+        newd = 2e0*(c*g + d)
+        newla = g + la
+        newm0 = kc + m0
+        conv = tt.le(abs(1e0 - kc/m0), 1e-8)
+        out = tt.switch(done, out, 0.5*np.pi*(newc*newm0 + newd)/
+                        (newm0*(newm0 + newla)))
+        newkc = 2e0*tt.sqrt(e)
+        newe = newkc*newm0
+        c = tt.switch(done, c, newc)
+        d = tt.switch(done, d, newd)
+        la = tt.switch(done, la, newla)
+        m0 = tt.switch(done, m0, newm0)
+        kc = tt.switch(done, kc, newkc)
+        e = tt.switch(done, e, newe)
+        done = done | conv
+        pass
+    return out
+# ---------------------------------- ----------------------------------
+# -- QUADRATIC LIMB DARKENED OCCULTATION -- --------------------------
+def tt_occultquad(z, u1, u2, p, tol=1e-6):
+    '''
+Mandel & Agol (2002) relative flux muo1 for separations z and
+0 < p < 1, same cases as occultquad.occultquad
+Points closer than tol to z = p or z = 1 - p, where the general
+expressions are 0/0 and lose precision, are evaluated at p + tol
+and 1 - p + tol: the flux is off by less than ~tol there and the
+gradient stays finite
+    '''
+    omega = 1e0 - u1/3e0 - u2/6e0
+    z = abs(z)
+    z = tt.switch(tt.lt(abs(z - p), tol), p + tol, z)
+    z = tt.switch(tt.lt(abs(z - 1e0 + p), tol), 1e0 - p + tol, z)
+    ingress = tt.gt(z, abs(1e0 - p)) & tt.lt(z, 1e0 + p)
+    inside = tt.le(z, 1e0 - p)
+
+    # Case 2, 7, 8 - ingress/egress
+    zi = tt.switch(ingress, z, 1e0 + p/2e0)
+    x1 = (p - zi)**2
+    x2 = (p + zi)**2
+    x3 = p**2 - zi**2
+    kap1 = tt.arccos(tt.clip((1e0 - p**2 + zi**2)/2e0/zi, -1e0, 1e0))
+    kap0 = tt.arccos(tt.clip((p**2 + zi**2 - 1e0)/2e0/p/zi, -1e0, 1e0))
+    lambdae1 = (p**2*kap0 + kap1 -
+                0.5*tt.sqrt(4e0*zi**2 - (1e0 + zi**2 - p**2)**2))/np.pi
+    # eta_1
+    etad1 = 1e0/2e0/np.pi*(kap1 + p**2*(p**2 + 2e0*zi**2)*kap0 -
+                           (1e0 + 5e0*p**2 + zi**2)/4e0*
+                           tt.sqrt((1e0 - x1)*(x2 - 1e0)))
+    q = tt.sqrt((1e0 - x1)/(x2 - x1))
+    Ek, Kk = tt_ellke(q)
+    # lambda_1
+    lambdad1 = 2e0/9e0/np.pi/tt.sqrt(x2 - x1)*(
+        ((1e0 - x2)*(2e0*x2 + x1 - 3e0) - 3e0*x3*(x2 - 2e0))*Kk +
+        (x2 - x1)*(zi**2 + 7e0*p**2 - 4e0)*Ek -
+        3e0*x3/x1*tt_ellpic_bulirsch(1e0/x1 - 1e0, q))
+
+    # Case 3, 9 - planet inside the stellar disk
+    zn = tt.switch(inside, z, tt.minimum(p, 1e0 - p)/2e0)
+    x1 = (p - zn)**2
+    x2 = (p + zn)**2
+    x3 = p**2 - zn**2
+    q = tt.sqrt((x2 - x1)/(1e0 - x1))
+    Ek, Kk = tt_ellke(q)
+    # lambda_2
+    lambdad2 = 2e0/9e0/np.pi/tt.sqrt(1e0 - x1)*(
+        (1e0 - 5e0*zn**2 + p**2 + x3**2)*Kk +
+        (1e0 - x1)*(zn**2 + 7e0*p**2 - 4e0)*Ek -
+        3e0*x3/x1*tt_ellpic_bulirsch(x2/x1 - 1e0, q))
+    # eta_2
+    etad2 = p**2/2e0*(p**2 + 2e0*zn**2)
+
+    lambdae = tt.switch(ingress, lambdae1, tt.switch(inside, p**2, 0e0))
+    lambdad = tt.switch(ingress, lambdad1, tt.switch(inside, lambdad2, 0e0))
+    etad = tt.switch(ingress, etad1, tt.switch(inside, etad2, 0e0))
+    lambdad += tt.switch(tt.gt(p, z), 2e0/3e0, 0e0)
+    muo1 = 1e0 - ((1e0 - u1 - 2e0*u2)*lambdae + (u1 + 2e0*u2)*lambdad +
+                  u2*etad)/omega
+    return muo1
+# ----------------------------------------- --------------------------